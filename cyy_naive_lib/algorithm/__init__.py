@@ -1,4 +1,5 @@
 from .generic import recursive_mutable_op, recursive_op
+from .hash import jump_consistent_hash, stable_hash
 from .mapping_op import (
     change_mapping_keys,
     change_mapping_values,
@@ -23,10 +24,12 @@ __all__ = [
     "flatten_seq",
     "get_mapping_items_by_key_order",
     "get_mapping_values_by_key_order",
+    "jump_consistent_hash",
     "mapping_to_list",
     "recursive_mutable_op",
     "recursive_op",
     "reduce_values_by_key",
     "search_sublists",
+    "stable_hash",
     "sublist",
 ]
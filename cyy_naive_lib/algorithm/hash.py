@@ -0,0 +1,42 @@
+import hashlib
+import pickle
+
+__UINT64_MASK = (1 << 64) - 1
+
+
+def stable_hash(obj: object) -> int:
+    """A 64 bit hash that, unlike hash(), doesn't change between processes."""
+    if isinstance(obj, int):
+        return obj & __UINT64_MASK
+    if isinstance(obj, str):
+        data = obj.encode()
+    elif isinstance(obj, bytes):
+        data = obj
+    else:
+        data = pickle.dumps(obj)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest())
+
+
+def fingerprint(obj: object) -> bytes | None:
+    """A 256 bit digest of the pickled obj, None if obj can't be pickled."""
+    try:
+        data = pickle.dumps(obj)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def jump_consistent_hash(key: object, bucket_num: int) -> int:
+    """Map key to one of bucket_num buckets with Google's jump consistent hash.
+
+    When bucket_num grows only about 1/bucket_num of the keys move.
+    """
+    assert bucket_num > 0, bucket_num
+    hashed_key = stable_hash(key)
+    bucket = -1
+    next_bucket = 0
+    while next_bucket < bucket_num:
+        bucket = next_bucket
+        hashed_key = (hashed_key * 2862933555777941757 + 1) & __UINT64_MASK
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((hashed_key >> 33) + 1)))
+    return bucket
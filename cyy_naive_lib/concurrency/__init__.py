@@ -5,26 +5,56 @@ from .batch import batch_process
 with contextlib.suppress(Exception):
     from .coroutine import ProcessPoolWithCoroutine
 from .executor import BlockingSubmitExecutor
+from .pipeline import Pipeline
 from .process_context import ManageredProcessContext, ProcessContext
-from .process_pool import ProcessPool
+from .process_pool import ProcessPool, WorkerRecyclingPolicy
 from .process_task_queue import ProcessTaskQueue
-from .task_queue import BatchPolicy, RetryableBatchPolicy, TaskQueue
+from .shared_memory_queue import MessageTooLargeError, SharedMemoryQueue
+from .task_queue import (
+    BatchPolicy,
+    ExpiredTask,
+    MemoryAwareBatchPolicy,
+    QueueType,
+    RetryableBatchPolicy,
+    SchedulingMode,
+    TaskOptions,
+    TaskPriority,
+    TaskQueue,
+    TaskQueueOptions,
+    is_out_of_memory_error,
+)
 from .thread_context import ThreadContext
 from .thread_pool import ThreadPool
 from .thread_task_queue import ThreadTaskQueue
+from .timer_wheel import TimerWheel
+from .worker_scaling import WorkerScalingPolicy
 
 __all__ = [
     "BatchPolicy",
     "BlockingSubmitExecutor",
+    "ExpiredTask",
     "ManageredProcessContext",
+    "MemoryAwareBatchPolicy",
+    "MessageTooLargeError",
+    "Pipeline",
     "ProcessContext",
     "ProcessPool",
     "ProcessPoolWithCoroutine",
     "ProcessTaskQueue",
+    "QueueType",
     "RetryableBatchPolicy",
+    "SchedulingMode",
+    "SharedMemoryQueue",
+    "TaskOptions",
+    "TaskPriority",
     "TaskQueue",
+    "TaskQueueOptions",
     "ThreadContext",
     "ThreadPool",
     "ThreadTaskQueue",
+    "TimerWheel",
+    "WorkerRecyclingPolicy",
+    "WorkerScalingPolicy",
     "batch_process",
+    "is_out_of_memory_error",
 ]
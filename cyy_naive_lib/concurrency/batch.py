@@ -1,27 +1,27 @@
+import itertools
 from collections.abc import Iterable
 
 from .task_queue import TaskQueue
 
 
-def batch_process(queue: TaskQueue, tasks: Iterable[object]) -> dict:
+def _merge_results(result: dict, data_list: list) -> int:
+    for data in data_list:
+        assert isinstance(data, dict)
+        result |= data
+    return len(data_list)
+
+
+def batch_process(
+    queue: TaskQueue, tasks: Iterable[object], chunk_size: int = 1
+) -> dict:
     assert not queue.has_data()
     result: dict = {}
     cnt = 0
-    for task in tasks:
-        queue.add_task(task)
-        cnt += 1
+    for chunk in itertools.batched(tasks, chunk_size):
+        queue.add_tasks(chunk)
+        cnt += len(chunk)
         while queue.has_data():
-            cnt -= 1
-            data = queue.get_data()
-            assert data.is_ok()
-            data_value = data.value()
-            assert isinstance(data_value, dict)
-            result |= data_value
+            cnt -= _merge_results(result, queue.get_many(max_items=cnt))
     while cnt > 0:
-        data = queue.get_data()
-        assert data.is_ok()
-        data_value = data.value()
-        assert isinstance(data_value, dict)
-        result |= data_value
-        cnt -= 1
+        cnt -= _merge_results(result, queue.get_many(max_items=cnt))
     return result
@@ -7,9 +7,12 @@ import queue
 import threading
 from collections.abc import Callable
 
+from ..storage.serializer import Serializer
+from .shared_memory_queue import SharedMemoryQueue
+
 
 class ConcurrencyContext:
-    def create_queue(self) -> multiprocessing.Queue | queue.Queue:
+    def create_queue(self, maxsize: int = 0) -> multiprocessing.Queue | queue.Queue:
         raise NotImplementedError
 
     def in_thread(self) -> bool:
@@ -21,6 +24,17 @@ class ConcurrencyContext:
     def create_pipe(self) -> tuple:
         raise NotImplementedError
 
+    def support_shared_memory(self) -> bool:
+        return False
+
+    def create_shared_memory_queue(
+        self,
+        maxsize: int = 0,
+        serializer: Serializer | None = None,
+        capacity: int | None = None,
+    ) -> SharedMemoryQueue:
+        raise NotImplementedError
+
     def create_event(self) -> threading.Event | multiprocessing.synchronize.Event:
         raise NotImplementedError
 
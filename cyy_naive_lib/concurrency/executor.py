@@ -1,18 +1,28 @@
 import concurrent
 import concurrent.futures
 import functools
+import threading
 import uuid
 from collections.abc import Callable
 
+from ..algorithm.hash import fingerprint
 from ..function import exception_aware_call
 from ..log import log_debug
 from ..storage import GlobalStore
 
 
 class ExecutorWrapper(concurrent.futures.Executor):
-    def __init__(self, executor: concurrent.futures.Executor) -> None:
+    def __init__(
+        self, executor: concurrent.futures.Executor, deduplicate_tasks: bool = False
+    ) -> None:
         self._executor: concurrent.futures.Executor = executor
         self.__futures: list[concurrent.futures.Future] = []
+        # submit() returns the Future of an identical call still pending or
+        # running instead of submitting it again
+        self.__deduplicate_tasks: bool = deduplicate_tasks
+        # call fingerprint -> Future
+        self.__inflight_futures: dict[bytes, concurrent.futures.Future] = {}
+        self.__inflight_lock = threading.Lock()
 
     @property
     def executor(self) -> concurrent.futures.Executor:
@@ -31,13 +41,38 @@ class ExecutorWrapper(concurrent.futures.Executor):
         Schedules the callable to be executed as fn(*args, **kwargs) and returns
         a Future instance representing the execution of the callable.
 
+        With deduplicate_tasks, a call whose pickled fn and arguments equal
+        those of a pending or running call shares that call's Future.
+
         Returns:
             A Future representing the given call.
         """
-        future = self._executor.submit(fn, *args, **kwargs)
-        self.__futures.append(future)
+        call_fingerprint = None
+        if self.__deduplicate_tasks:
+            call_fingerprint = fingerprint((fn, args, kwargs))
+        if call_fingerprint is None:
+            future = self._executor.submit(fn, *args, **kwargs)
+            self.__futures.append(future)
+            return future
+        with self.__inflight_lock:
+            future = self.__inflight_futures.get(call_fingerprint)
+            if future is not None:
+                return future
+            future = self._executor.submit(fn, *args, **kwargs)
+            self.__futures.append(future)
+            self.__inflight_futures[call_fingerprint] = future
+        future.add_done_callback(
+            functools.partial(self.__remove_inflight_future, call_fingerprint)
+        )
         return future
 
+    def __remove_inflight_future(
+        self, call_fingerprint: bytes, future: concurrent.futures.Future
+    ) -> None:
+        with self.__inflight_lock:
+            if self.__inflight_futures.get(call_fingerprint) is future:
+                self.__inflight_futures.pop(call_fingerprint)
+
     def wait_results(
         self,
         timeout: float | None = None,
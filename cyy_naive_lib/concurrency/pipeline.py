@@ -0,0 +1,83 @@
+import time
+from collections.abc import Callable, Iterable
+
+from ..function import Expected
+from .context import ConcurrencyContext
+from .process_context import ProcessContext
+from .task_queue import BatchPolicy, SchedulingMode, TaskQueue, TaskQueueOptions
+
+
+class Pipeline:
+    """Chain TaskQueues so that the results of a stage are the tasks of the next.
+
+    The workers of a stage put their results straight into the task queue of
+    the next stage. Giving a stage a task_queue_maxsize stalls the stages
+    before it when it falls behind, up to add_task.
+    All stages share mp_ctx, use_thread chooses threads or processes per stage.
+    """
+
+    def __init__(self, mp_ctx: ConcurrencyContext | None = None) -> None:
+        if mp_ctx is None:
+            mp_ctx = ProcessContext()
+        self.__mp_ctx: ConcurrencyContext = mp_ctx
+        self.__stages: list[tuple[TaskQueue, Callable, bool]] = []
+
+    @property
+    def stages(self) -> list[TaskQueue]:
+        return [stage[0] for stage in self.__stages]
+
+    def add_stage(
+        self,
+        worker_fun: Callable,
+        worker_num: int = 1,
+        use_thread: bool = False,
+        batch_policy_type: type[BatchPolicy] | None = None,
+        options: TaskQueueOptions | None = None,
+    ) -> TaskQueue:
+        # The results of the previous stage go to the shared task queue.
+        if (
+            self.__stages
+            and options is not None
+            and options.scheduling_mode == SchedulingMode.WorkStealing
+        ):
+            raise ValueError("only the first stage can use work stealing")
+        queue = TaskQueue(
+            mp_ctx=self.__mp_ctx,
+            worker_num=worker_num,
+            batch_policy_type=batch_policy_type,
+            options=options,
+        )
+        self.__stages.append((queue, worker_fun, use_thread))
+        return queue
+
+    def start(self) -> None:
+        assert self.__stages
+        next_queue: TaskQueue | None = None
+        # The next stage creates the queue linked to the results of this stage.
+        for queue, worker_fun, use_thread in reversed(self.__stages):
+            if next_queue is not None:
+                queue.link_queue("__result", next_queue, "__task")
+            queue.start(worker_fun=worker_fun, use_thread=use_thread)
+            next_queue = queue
+
+    def stop(self, timeout: float | None = None) -> None:
+        # A stage stops after the stages before it, so it gets all their results.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for queue in self.stages:
+            queue.stop(
+                timeout=None
+                if deadline is None
+                else max(deadline - time.monotonic(), 0)
+            )
+
+    def add_task(self, task: object, **kwargs: object) -> None:
+        self.stages[0].add_task(task, **kwargs)  # type: ignore[arg-type]
+
+    def add_tasks(self, tasks: Iterable[object], **kwargs: object) -> None:
+        self.stages[0].add_tasks(tasks, **kwargs)  # type: ignore[arg-type]
+
+    def get_data(self, timeout: float | None = None) -> Expected[object]:
+        return self.stages[-1].get_data(timeout=timeout)
+
+    def get_many(self, max_items: int, timeout: float | None = None) -> list:
+        return self.stages[-1].get_many(max_items=max_items, timeout=timeout)
@@ -7,22 +7,41 @@ import multiprocessing.managers
 import multiprocessing.synchronize
 from typing import ClassVar
 
+from ..storage.serializer import Serializer
 from .context import ConcurrencyContext
+from .shared_memory_queue import SharedMemoryQueue
 
 
 class ProcessContext(ConcurrencyContext):
-    def __init__(self, ctx: multiprocessing.context.BaseContext | None = None) -> None:
+    """Create processes by the start method of ctx, spawn by default.
+
+    With the forkserver start method, preload_modules are imported once by
+    the server, so that new processes start with them in place.
+    """
+
+    def __init__(
+        self,
+        ctx: multiprocessing.context.BaseContext | None = None,
+        start_method: str | None = None,
+        preload_modules: list[str] | None = None,
+    ) -> None:
         if ctx is None:
-            ctx = multiprocessing.get_context("spawn")
-        elif hasattr(ctx, "get_context"):
-            ctx = ctx.get_context("spawn")
+            ctx = multiprocessing.get_context(start_method or "spawn")
+        elif start_method is not None:
+            ctx = ctx.get_context(start_method)
+        if preload_modules:
+            assert ctx.get_start_method() == "forkserver", ctx.get_start_method()
+            ctx.set_forkserver_preload(preload_modules)  # type: ignore[attr-defined]
         self.__underlying_ctx: multiprocessing.context.BaseContext = ctx
 
     def get_ctx(self) -> multiprocessing.context.BaseContext:
         return self.__underlying_ctx
 
-    def create_queue(self) -> multiprocessing.Queue:  # type: ignore[type-arg]
-        return self.get_ctx().Queue()
+    def get_start_method(self) -> str:
+        return self.__underlying_ctx.get_start_method()
+
+    def create_queue(self, maxsize: int = 0) -> multiprocessing.Queue:  # type: ignore[type-arg]
+        return self.get_ctx().Queue(maxsize=maxsize)
 
     def support_pipe(self) -> bool:
         return True
@@ -30,6 +49,24 @@ class ProcessContext(ConcurrencyContext):
     def create_pipe(self) -> tuple:
         return self.get_ctx().Pipe()
 
+    def support_shared_memory(self) -> bool:
+        return True
+
+    def create_shared_memory_queue(
+        self,
+        maxsize: int = 0,
+        serializer: Serializer | None = None,
+        capacity: int | None = None,
+    ) -> SharedMemoryQueue:
+        lock = self.get_ctx().RLock()  # type: ignore[attr-defined]
+        return SharedMemoryQueue(
+            condition=self.get_ctx().Condition(lock),  # type: ignore[attr-defined]
+            capacity=capacity,
+            maxsize=maxsize,
+            serializer=serializer,
+            not_full_condition=self.get_ctx().Condition(lock),  # type: ignore[attr-defined]
+        )
+
     def create_event(self) -> multiprocessing.synchronize.Event:
         return self.get_ctx().Event()
 
@@ -50,5 +87,19 @@ class ManageredProcessContext(ProcessContext):
             self.managers[underlying_ctx] = underlying_ctx.Manager()  # type: ignore[attr-defined]
         return self.managers[underlying_ctx]  # type: ignore[return-value]
 
+    def create_shared_memory_queue(
+        self,
+        maxsize: int = 0,
+        serializer: Serializer | None = None,
+        capacity: int | None = None,
+    ) -> SharedMemoryQueue:
+        # The conditions of a manager can't share a lock.
+        return SharedMemoryQueue(
+            condition=self.get_ctx().Condition(),  # type: ignore[attr-defined]
+            capacity=capacity,
+            maxsize=maxsize,
+            serializer=serializer,
+        )
+
     def create_worker(self, *args: object, **kwargs: object) -> multiprocessing.Process:  # type: ignore[override]
         return super().get_ctx().Process(*args, **kwargs)  # type: ignore[attr-defined]
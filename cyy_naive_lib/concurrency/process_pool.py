@@ -1,7 +1,18 @@
 import concurrent.futures
+import copy
 import functools
+import os
+import queue
 from collections.abc import Callable
+from concurrent.futures.process import (
+    _ExceptionWithTraceback,
+    _ResultItem,
+    _sendback_result,
+)
+
+import psutil
 
+from ..log import log_error
 from .executor import ExecutorWrapper
 from .process_context import ProcessContext
 from .process_initialization import (
@@ -10,24 +21,136 @@ from .process_initialization import (
 )
 
 
+class WorkerRecyclingPolicy:
+    """Decide when a worker process of ExtendedProcessPoolExecutor is replaced.
+
+    A worker exits after max_tasks tasks, or after a task leaves its RSS above
+    max_rss bytes or more than max_rss_growth bytes above the RSS it had once
+    initialized. A worker idle for max_idle_seconds exits too, and the
+    executor starts a new one when tasks arrive.
+    """
+
+    def __init__(
+        self,
+        max_tasks: int | None = 1000,
+        max_rss: int | None = None,
+        max_rss_growth: int | None = 1024 * 1024 * 1024,
+        max_idle_seconds: float | None = None,
+    ) -> None:
+        self.max_tasks: int | None = max_tasks
+        self.max_rss: int | None = max_rss
+        self.max_rss_growth: int | None = max_rss_growth
+        self.max_idle_seconds: float | None = max_idle_seconds
+
+    def should_recycle(self, task_num: int, rss: int, initial_rss: int) -> bool:
+        if self.max_tasks is not None and task_num >= self.max_tasks:
+            return True
+        if self.max_rss is not None and rss > self.max_rss:
+            return True
+        return (
+            self.max_rss_growth is not None and rss - initial_rss > self.max_rss_growth
+        )
+
+
+def _recycling_process_worker(
+    call_queue: object,
+    result_queue: object,
+    initializer: Callable | None,
+    initargs: tuple,
+    recycling_policy: WorkerRecyclingPolicy,
+) -> None:
+    # concurrent.futures.process._process_worker deciding when to exit by
+    # recycling_policy
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        # pylint: disable=broad-exception-caught
+        except BaseException as e:
+            log_error("exception in initializer:%s", e)
+            # The parent notices that the process stopped and marks the pool
+            # broken
+            return
+    process = psutil.Process()
+    initial_rss = process.memory_info().rss
+    task_num = 0
+    while True:
+        try:
+            call_item = call_queue.get(  # type: ignore[attr-defined]
+                block=True, timeout=recycling_policy.max_idle_seconds
+            )
+        except queue.Empty:
+            # A result without a work item retires the worker
+            result_queue.put(_ResultItem(None, exit_pid=os.getpid()))  # type: ignore[attr-defined]
+            return
+        if call_item is None:
+            # Wake up queue management thread
+            result_queue.put(os.getpid())  # type: ignore[attr-defined]
+            return
+        task_num += 1
+        result = None
+        exception = None
+        try:
+            result = call_item.fn(*call_item.args, **call_item.kwargs)
+        # pylint: disable=broad-exception-caught
+        except BaseException as e:
+            exception = _ExceptionWithTraceback(e, e.__traceback__)
+        exit_pid = None
+        if recycling_policy.should_recycle(
+            task_num=task_num,
+            rss=process.memory_info().rss,
+            initial_rss=initial_rss,
+        ):
+            exit_pid = os.getpid()
+        _sendback_result(
+            result_queue,
+            call_item.work_id,
+            result=result,
+            exception=exception,
+            exit_pid=exit_pid,
+        )
+        # Liberate the resource as soon as possible
+        del call_item, result
+        if exit_pid is not None:
+            return
+
+
 class ExtendedProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
     def __init__(
         self,
         initializer: None | Callable = None,
         initargs: dict | None = None,
+        recycling_policy: WorkerRecyclingPolicy | None = None,
         **kwargs,
     ) -> None:
+        """Unless fork is used, worker processes are recycled by recycling_policy.
+
+        Without a recycling_policy or max_tasks_per_child, the default
+        WorkerRecyclingPolicy applies. Fork can't start processes on demand,
+        so it doesn't support recycling.
+        """
         real_initarg: dict = {}
         real_initarg["initializers"] = [initializer]
         real_initarg["initargs_list"] = [{} if initargs is None else initargs]
         pass_process_data = "process_data" in real_initarg["initargs_list"][0]
         if "mp_context" not in kwargs:
             kwargs["mp_context"] = ProcessContext().get_ctx()
-        if "max_tasks_per_child" not in kwargs:
-            mp_ctx = kwargs.get("mp_context")
-            start_method = getattr(mp_ctx, "get_start_method", lambda: None)()
-            if start_method != "fork":
-                kwargs["max_tasks_per_child"] = 1
+        mp_ctx = kwargs.get("mp_context")
+        start_method = getattr(mp_ctx, "get_start_method", lambda: None)()
+        if start_method == "fork":
+            if recycling_policy is not None:
+                raise ValueError(
+                    "recycling_policy is incompatible with the 'fork' start method"
+                )
+        elif recycling_policy is None and "max_tasks_per_child" not in kwargs:
+            recycling_policy = WorkerRecyclingPolicy()
+        elif recycling_policy is not None and kwargs.get("max_tasks_per_child"):
+            # The worker exits after the fewer tasks of the two limits
+            recycling_policy = copy.copy(recycling_policy)
+            max_tasks = kwargs["max_tasks_per_child"]
+            if recycling_policy.max_tasks is not None:
+                max_tasks = min(max_tasks, recycling_policy.max_tasks)
+            recycling_policy.max_tasks = max_tasks
+        self.__recycling_policy: WorkerRecyclingPolicy | None = recycling_policy
 
         init_func, wrap_initargs = make_initializer()
         super().__init__(
@@ -37,6 +160,23 @@ class ExtendedProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
         )
         self.__pass_process_data = pass_process_data
 
+    def _spawn_process(self) -> None:
+        if self.__recycling_policy is None:
+            super()._spawn_process()
+            return
+        process = self._mp_context.Process(  # type: ignore[attr-defined]
+            target=_recycling_process_worker,
+            args=(
+                self._call_queue,  # type: ignore[attr-defined]
+                self._result_queue,  # type: ignore[attr-defined]
+                self._initializer,  # type: ignore[attr-defined]
+                self._initargs,  # type: ignore[attr-defined]
+                self.__recycling_policy,
+            ),
+        )
+        process.start()
+        self._processes[process.pid] = process  # type: ignore[attr-defined]
+
     @classmethod
     def wrapped_fn(
         cls, fn: Callable, pass_process_data: bool, *args: object, **kwargs: object
@@ -58,5 +198,7 @@ class ExtendedProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
 
 
 class ProcessPool(ExecutorWrapper):
-    def __init__(self, **kwargs) -> None:
-        super().__init__(ExtendedProcessPoolExecutor(**kwargs))
+    def __init__(self, deduplicate_tasks: bool = False, **kwargs) -> None:
+        super().__init__(
+            ExtendedProcessPoolExecutor(**kwargs), deduplicate_tasks=deduplicate_tasks
+        )
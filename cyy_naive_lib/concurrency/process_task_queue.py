@@ -9,9 +9,13 @@ class ProcessTaskQueue(TaskQueue):
         mp_ctx: ConcurrencyContext | None = None,
         worker_num: int = 1,
         batch_policy_type: type[BatchPolicy] | None = None,
+        **kwargs,
     ) -> None:
         if mp_ctx is None:
             mp_ctx = ProcessContext()
         super().__init__(
-            mp_ctx=mp_ctx, worker_num=worker_num, batch_policy_type=batch_policy_type
+            mp_ctx=mp_ctx,
+            worker_num=worker_num,
+            batch_policy_type=batch_policy_type,
+            **kwargs,
         )
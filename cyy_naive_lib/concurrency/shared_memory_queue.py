@@ -0,0 +1,172 @@
+import os
+import queue
+import struct
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.shared_memory import SharedMemory
+
+from ..storage.serializer import Serializer
+
+
+class MessageTooLargeError(ValueError):
+    """Raised by SharedMemoryQueue.put for a message over the queue capacity."""
+
+
+class SharedMemoryQueue:
+    """A multi-producer multi-consumer queue backed by a shared memory ring buffer.
+
+    Each message is pickled straight into the ring buffer, so unlike
+    multiprocessing.Queue there is no feeder thread and no pipe copy. With a
+    serializer, the out-of-band buffers of a message are copied into the ring
+    buffer directly instead of through the pickle stream.
+    If not_full_condition shares the lock of condition, producers wait on it
+    and consumers on condition, so every put or get wakes one waiter only.
+    """
+
+    # head offset, tail offset, message number
+    __header = struct.Struct("QQQ")
+    __length = struct.Struct("Q")
+    # Bytes of the ring buffer unless capacity is given
+    default_capacity: int = 16 * 1024 * 1024
+
+    def __init__(
+        self,
+        condition: object,
+        capacity: int | None = None,
+        maxsize: int = 0,
+        serializer: Serializer | None = None,
+        not_full_condition: object | None = None,
+    ) -> None:
+        if capacity is None:
+            capacity = self.default_capacity
+        assert capacity > self.__length.size, capacity
+        self.__capacity: int = capacity
+        # maximum message number, unlimited if not positive
+        self.__maxsize: int = maxsize
+        self.__condition = condition
+        self.__not_full_condition = not_full_condition
+        self.__serializer: Serializer | None = serializer
+        self.__memory: SharedMemory = SharedMemory(
+            create=True, size=self.__header.size + capacity
+        )
+        self.__owner_pid: int = os.getpid()
+        self.__header.pack_into(self.__memory.buf, 0, 0, 0, 0)
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_SharedMemoryQueue__memory"] = self.__memory.name
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        # The creator owns the block, so the attached side doesn't track it.
+        self.__memory = SharedMemory(
+            name=state["_SharedMemoryQueue__memory"], track=False
+        )
+
+    def put(
+        self, obj: object, block: bool = True, timeout: float | None = None
+    ) -> None:
+        if self.__serializer is not None:
+            frames = [
+                memoryview(frame).cast("B")
+                for frame in self.__serializer.dumps_frames(obj)
+            ]
+        else:
+            frames = [memoryview(ForkingPickler.dumps(obj))]
+        payload_size = sum(frame.nbytes for frame in frames)
+        message_size = self.__length.size + payload_size
+        if message_size > self.__capacity:
+            raise MessageTooLargeError(
+                f"message of {message_size} bytes exceeds queue capacity {self.__capacity}"
+            )
+        not_full_condition = self.__not_full_condition or self.__condition
+        with self.__condition:  # type: ignore[attr-defined]
+            if not not_full_condition.wait_for(  # type: ignore[attr-defined]
+                lambda: self.__free_space() >= message_size and not self.full(),
+                timeout if block else 0,
+            ):
+                raise queue.Full
+            head, tail, message_num = self.__header.unpack_from(self.__memory.buf, 0)
+            self.__write(tail, memoryview(self.__length.pack(payload_size)))
+            offset = tail + self.__length.size
+            for frame in frames:
+                self.__write(offset, frame)
+                offset += frame.nbytes
+            self.__header.pack_into(
+                self.__memory.buf, 0, head, tail + message_size, message_num + 1
+            )
+            self.__notify(self.__condition)
+
+    def get(self, block: bool = True, timeout: float | None = None) -> object:
+        with self.__condition:  # type: ignore[attr-defined]
+            if not self.__condition.wait_for(  # type: ignore[attr-defined]
+                lambda: self.qsize() > 0, timeout if block else 0
+            ):
+                raise queue.Empty
+            head, tail, message_num = self.__header.unpack_from(self.__memory.buf, 0)
+            (payload_size,) = self.__length.unpack(
+                self.__read(head, self.__length.size)
+            )
+            payload = self.__read(head + self.__length.size, payload_size)
+            self.__header.pack_into(
+                self.__memory.buf,
+                0,
+                head + self.__length.size + payload_size,
+                tail,
+                message_num - 1,
+            )
+            self.__notify(self.__not_full_condition)
+        if self.__serializer is not None:
+            return self.__serializer.loads(payload)
+        return ForkingPickler.loads(payload)
+
+    def qsize(self) -> int:
+        return self.__header.unpack_from(self.__memory.buf, 0)[2]
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self.__maxsize <= self.qsize()
+
+    def close(self) -> None:
+        self.__memory.close()
+        if os.getpid() == self.__owner_pid:
+            self.__memory.unlink()
+
+    def __notify(self, condition: object | None) -> None:
+        if self.__not_full_condition is None:
+            # Producers and consumers wait on the same condition
+            self.__condition.notify_all()  # type: ignore[attr-defined]
+        else:
+            condition.notify()  # type: ignore[attr-defined]
+
+    def __free_space(self) -> int:
+        head, tail, _ = self.__header.unpack_from(self.__memory.buf, 0)
+        return self.__capacity - (tail - head)
+
+    def __write(self, offset: int, view: memoryview) -> None:
+        buf = self.__memory.buf
+        begin = offset % self.__capacity
+        first_part = min(view.nbytes, self.__capacity - begin)
+        start = self.__header.size + begin
+        buf[start : start + first_part] = view[:first_part]
+        if first_part < view.nbytes:
+            start = self.__header.size
+            buf[start : start + view.nbytes - first_part] = view[first_part:]
+
+    def __read(self, offset: int, size: int) -> bytearray:
+        # Writable, so that arrays loaded from it are writable
+        buf = self.__memory.buf
+        begin = offset % self.__capacity
+        first_part = min(size, self.__capacity - begin)
+        start = self.__header.size + begin
+        data = bytearray(buf[start : start + first_part])
+        if first_part < size:
+            start = self.__header.size
+            data += buf[start : start + size - first_part]
+        return data
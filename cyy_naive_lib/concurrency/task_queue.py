@@ -1,17 +1,33 @@
+import collections
+import concurrent.futures
 import copy
+import functools
+import itertools
 import math
-import multiprocessing.context
+import multiprocessing.connection
+import multiprocessing.queues
 import multiprocessing.synchronize
 import os
+import pickle
 import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
 import threading
+import time
 import traceback
-from collections.abc import Callable
-from enum import StrEnum, auto
+from collections.abc import Callable, Generator, Iterable
+from dataclasses import dataclass
+from enum import IntEnum, StrEnum, auto
+from multiprocessing.reduction import ForkingPickler
+from pathlib import Path
 from types import TracebackType
 from typing import Self
 
 import psutil
+from filelock import FileLock
 
 from cyy_naive_lib.log import (
     log_debug,
@@ -20,21 +36,141 @@ from cyy_naive_lib.log import (
 )
 from cyy_naive_lib.time_counter import TimeCounter
 
+from ..algorithm.hash import fingerprint, jump_consistent_hash
 from ..function import Expected
+from ..reflection import call_fun
+from ..storage.json import load_json, save_json
+from ..storage.serializer import Serializer, get_default_serializer
+from ..storage.storage import SyncedDataStorage
 from .context import ConcurrencyContext
 from .process_context import ProcessContext
+from .shared_memory_queue import MessageTooLargeError
+from .thread_context import ThreadQueue
+from .timer_wheel import TimerWheel
+from .worker_scaling import WorkerScalingPolicy
+
+if sys.platform != "win32":
+    import resource
 
 
 class QueueType(StrEnum):
     Pipe = auto()
     Queue = auto()
+    SharedMemory = auto()
+
+
+class SchedulingMode(StrEnum):
+    # All workers take tasks from the shared __task queue.
+    Shared = auto()
+    # Each worker takes tasks from its own queue and steals from the others when idle.
+    WorkStealing = auto()
+
+
+class TaskPriority(IntEnum):
+    # Workers take High tasks before their own and shared tasks, and Low
+    # tasks only when there is nothing else.
+    High = auto()
+    Normal = auto()
+    Low = auto()
+
+
+@dataclass(kw_only=True)
+class TaskOptions:
+    """Where and when the tasks of one add_task call run."""
+
+    # Tasks sharing the same key go to the same worker. In WorkStealing mode
+    # the affinity is a hint, an idle worker may still steal keyed tasks.
+    # Needs use_task_keys in TaskQueueOptions.
+    key: object = None
+    # Ignored for keyed tasks, needs use_task_priorities in TaskQueueOptions
+    priority: TaskPriority = TaskPriority.Normal
+    # A task not started by the deadline, a time.time() timestamp, is dropped
+    # without running.
+    deadline: float | None = None
+
+
+class ExpiredTask:
+    """Put into __result in place of the result of a task past its deadline."""
+
+    def __init__(self, task: object) -> None:
+        self.task = task
 
 
 class BatchPolicy:
+    """Search the batch size with the least processing time per task.
+
+    The per task time of each batch size is tracked by an exponentially
+    weighted mean and variance. The search doubles the best batch size until
+    it gets slower, bisects between the best batch size and its measured
+    neighbours, and then keeps the batch size with the lowest confidence
+    bound so that noisy measurements get re-sampled.
+    """
+
+    max_batch_size: int = 4096
+    # weight of a new sample in the moving averages
+    smoothing_factor: float = 0.2
+    # stop bisecting when the neighbours are closer than this fraction
+    resolution: float = 0.125
+    # seconds between two merges with the state file
+    sync_interval: float = 1
+
     def __init__(self) -> None:
-        self._mean_processing_times: dict = {}
+        self._mean_processing_times: dict[int, float] = {}
+        self._processing_time_variances: dict[int, float] = {}
+        self._sample_numbers: dict[int, int] = {}
+        self._update_times: dict[int, float] = {}
         self.__time_counter: TimeCounter = TimeCounter()
         self._current_batch_size: int | None = None
+        self.__state_file: str | None = None
+        self.__last_sync_time: float = 0
+
+    def set_state_file(self, state_file: str) -> None:
+        """Share the measurements with other policies using the same file."""
+        self.__state_file = state_file
+
+    def sync_state(self, force: bool = False) -> None:
+        """Merge the state file into this policy and write the result back.
+
+        For each batch size the newer measurement wins.
+        """
+        if self.__state_file is None:
+            return
+        if not force and time.monotonic() - self.__last_sync_time < self.sync_interval:
+            return
+        self.__last_sync_time = time.monotonic()
+        with FileLock(self.__state_file + ".lock", timeout=60):
+            if Path(self.__state_file).is_file():
+                state = load_json(self.__state_file)
+                assert isinstance(state, dict)
+                self._merge_state(state)
+            save_json(self._get_state(), self.__state_file, backup=False)
+
+    def _get_state(self) -> dict:
+        return {
+            "processing_times": {
+                str(batch_size): [
+                    mean_processing_time,
+                    self._processing_time_variances[batch_size],
+                    self._sample_numbers[batch_size],
+                    self._update_times[batch_size],
+                ]
+                for batch_size, mean_processing_time in self._mean_processing_times.items()
+            }
+        }
+
+    def _merge_state(self, state: dict) -> None:
+        for batch_size_str, (
+            mean_processing_time,
+            variance,
+            sample_number,
+            update_time,
+        ) in state.get("processing_times", {}).items():
+            batch_size = int(batch_size_str)
+            if update_time > self._update_times.get(batch_size, -math.inf):
+                self._mean_processing_times[batch_size] = mean_processing_time
+                self._processing_time_variances[batch_size] = variance
+                self._sample_numbers[batch_size] = sample_number
+                self._update_times[batch_size] = update_time
 
     def _start_batch(self) -> None:
         assert self._current_batch_size is not None
@@ -43,35 +179,84 @@ class BatchPolicy:
     def _end_batch(self) -> None:
         assert self._current_batch_size is not None
         batch_size = self._current_batch_size
-        new_mean_time = self.__time_counter.elapsed_milliseconds() / batch_size
-        if batch_size in self._mean_processing_times:
-            new_mean_time = (
-                self._mean_processing_times[batch_size] + new_mean_time
-            ) / 2
-        self._mean_processing_times[batch_size] = new_mean_time
+        self._add_sample(
+            batch_size, self.__time_counter.elapsed_milliseconds() / batch_size
+        )
         self._current_batch_size = None
+        self.sync_state()
+
+    def _add_sample(self, batch_size: int, processing_time: float) -> None:
+        self._update_times[batch_size] = time.time()
+        if batch_size not in self._mean_processing_times:
+            self._mean_processing_times[batch_size] = processing_time
+            self._processing_time_variances[batch_size] = 0
+            self._sample_numbers[batch_size] = 1
+            return
+        diff = processing_time - self._mean_processing_times[batch_size]
+        self._mean_processing_times[batch_size] += self.smoothing_factor * diff
+        self._processing_time_variances[batch_size] = (1 - self.smoothing_factor) * (
+            self._processing_time_variances[batch_size]
+            + self.smoothing_factor * diff * diff
+        )
+        self._sample_numbers[batch_size] += 1
 
     def _cancel_batch(self) -> None:
         self._current_batch_size = None
 
+    def is_batch_size_allowed(self, batch_size: int) -> bool:
+        return 1 <= batch_size <= self.max_batch_size
+
     def explore_batch_size(self, initial_batch_size: int) -> int:
         assert initial_batch_size >= 1, initial_batch_size
-        batch_size = initial_batch_size
-        assert batch_size in self._mean_processing_times
-        while (
-            batch_size + 1 not in self._mean_processing_times
-            or self._mean_processing_times[batch_size] == 0
-            or math.fabs(
-                self._mean_processing_times[batch_size + 1]
-                - self._mean_processing_times[batch_size]
-            )
-            / self._mean_processing_times[batch_size]
-            < 0.1
-        ):
-            batch_size += 1
+        if not self._mean_processing_times:
+            return initial_batch_size
+        best_batch_size = min(
+            self._mean_processing_times, key=self._mean_processing_times.__getitem__
+        )
+        for batch_size in self.__get_neighbours(best_batch_size):
             if batch_size not in self._mean_processing_times:
                 return batch_size
-        return batch_size
+        return min(
+            (
+                batch_size
+                for batch_size in self._mean_processing_times
+                if self.is_batch_size_allowed(batch_size)
+            ),
+            key=self.__get_lower_bound,
+            default=1,
+        )
+
+    def __get_lower_bound(self, batch_size: int) -> float:
+        return self._mean_processing_times[batch_size] - math.sqrt(
+            self._processing_time_variances[batch_size]
+            / self._sample_numbers[batch_size]
+        )
+
+    def __get_neighbours(self, batch_size: int) -> Generator[int]:
+        larger_batch_size = min(
+            (size for size in self._mean_processing_times if size > batch_size),
+            default=None,
+        )
+        smaller_batch_size = max(
+            (size for size in self._mean_processing_times if size < batch_size),
+            default=None,
+        )
+        min_gap = max(1, int(batch_size * self.resolution))
+        if larger_batch_size is None:
+            neighbour = min(batch_size * 2, self.max_batch_size)
+        else:
+            neighbour = (batch_size + larger_batch_size) // 2
+        while neighbour - batch_size >= min_gap:
+            if self.is_batch_size_allowed(neighbour):
+                yield neighbour
+                break
+            neighbour = (batch_size + neighbour) // 2
+        if smaller_batch_size is None:
+            neighbour = batch_size // 2
+        else:
+            neighbour = (batch_size + smaller_batch_size) // 2
+        if batch_size - neighbour >= min_gap and self.is_batch_size_allowed(neighbour):
+            yield neighbour
 
     def set_current_batch_size(self, batch_size: int) -> None:
         assert batch_size >= 1, batch_size
@@ -94,28 +279,72 @@ class BatchPolicy:
             self._cancel_batch()
 
 
+def is_out_of_memory_error(exception: BaseException) -> bool:
+    return (
+        isinstance(exception, MemoryError) or "out of memory" in str(exception).lower()
+    )
+
+
 class RetryableBatchPolicy(BatchPolicy):
-    def __init__(self) -> None:
+    """Forbid batch sizes that failed, and every larger one.
+
+    Without a cool_down the ban is permanent. With a cool_down in seconds the
+    ban expires after cool_down * 2**(failures - 1) seconds, capped at
+    max_cool_down, and a later success at the size lifts it. If is_retryable
+    is given, only the exceptions it accepts, such as is_out_of_memory_error,
+    are blamed on the batch size.
+    """
+
+    def __init__(
+        self,
+        cool_down: float | None = None,
+        max_cool_down: float = 3600,
+        is_retryable: Callable[[BaseException], bool] | None = None,
+    ) -> None:
         super().__init__()
-        self._no_workable_batch_sizes: set[int] = set()
+        # batch size -> the time when the ban ends
+        self._no_workable_batch_sizes: dict[int, float] = {}
+        self._failure_numbers: dict[int, int] = {}
+        self.__cool_down: float | None = cool_down
+        self.__max_cool_down: float = max_cool_down
+        self.__is_retryable = is_retryable
 
     def set_current_batch_size(self, batch_size: int) -> None:
         assert self.is_batch_size_allowed(batch_size)
         super().set_current_batch_size(batch_size)
 
     def is_batch_size_allowed(self, batch_size: int) -> bool:
-        return all(
-            batch_size < no_workable_batch_size
-            for no_workable_batch_size in self._no_workable_batch_sizes
+        now = time.time()
+        return super().is_batch_size_allowed(batch_size) and all(
+            batch_size < no_workable_batch_size or end_time <= now
+            for no_workable_batch_size, end_time in self._no_workable_batch_sizes.items()
         )
 
-    def explore_batch_size(self, initial_batch_size: int) -> int:
-        batch_size = super().explore_batch_size(initial_batch_size)
-        if batch_size > 1:
-            while not self.is_batch_size_allowed(batch_size):
-                batch_size -= 1
-        assert batch_size >= 1
-        return batch_size
+    def is_retryable(self, exception: BaseException) -> bool:
+        return self.__is_retryable is None or self.__is_retryable(exception)
+
+    def __forbid_batch_size(self, batch_size: int) -> None:
+        failure_number = self._failure_numbers.get(batch_size, 0) + 1
+        self._failure_numbers[batch_size] = failure_number
+        end_time = math.inf
+        if self.__cool_down is not None:
+            end_time = time.time() + min(
+                self.__cool_down * 2 ** (failure_number - 1), self.__max_cool_down
+            )
+        log_error("Forbid batch size %s until %s", batch_size, end_time)
+        self._no_workable_batch_sizes[batch_size] = end_time
+
+    def _end_batch(self) -> None:
+        assert self._current_batch_size is not None
+        # The size works again, so lift the expired bans it covers. A lifted
+        # ban is kept as ending now without failures, so that merging the
+        # older ban from the state file doesn't bring it back.
+        now = time.time()
+        for batch_size in self._no_workable_batch_sizes:
+            if batch_size <= self._current_batch_size:
+                self._no_workable_batch_sizes[batch_size] = now
+                self._failure_numbers[batch_size] = 0
+        super()._end_batch()
 
     def __exit__(
         self,
@@ -123,26 +352,266 @@ class RetryableBatchPolicy(BatchPolicy):
         exc_value: BaseException | None,
         traceback: TracebackType | None,
     ) -> None:
-        if exc_value is not None:
-            assert self._current_batch_size is not None
-            log_error("Forbid batch size %s", self._current_batch_size)
-            self._no_workable_batch_sizes.add(self._current_batch_size)
+        assert self._current_batch_size is not None
+        # A failing batch of one task is not caused by the batch size.
+        if (
+            exc_value is not None
+            and self._current_batch_size > 1
+            and self.is_retryable(exc_value)
+        ):
+            self.__forbid_batch_size(self._current_batch_size)
+            self.sync_state(force=True)
         super().__exit__(exc_type, exc_value, traceback)
 
+    def _get_state(self) -> dict:
+        state = super()._get_state()
+        state["no_workable_batch_sizes"] = {
+            str(batch_size): [end_time, self._failure_numbers.get(batch_size, 1)]
+            for batch_size, end_time in self._no_workable_batch_sizes.items()
+        }
+        return state
+
+    def _merge_state(self, state: dict) -> None:
+        super()._merge_state(state)
+        for batch_size_str, (end_time, failure_number) in state.get(
+            "no_workable_batch_sizes", {}
+        ).items():
+            batch_size = int(batch_size_str)
+            if end_time > self._no_workable_batch_sizes.get(batch_size, -math.inf):
+                self._no_workable_batch_sizes[batch_size] = end_time
+                self._failure_numbers[batch_size] = failure_number
+
+
+def _get_peak_rss() -> int:
+    """Return the highest RSS the process has reached in bytes."""
+    if sys.platform == "win32":
+        return psutil.Process().memory_info().peak_wset
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class MemoryAwareBatchPolicy(RetryableBatchPolicy):
+    """Cap the batch size by the memory a batch is expected to take.
+
+    During each batch the policy tracks how far the RSS of the worker rises
+    above its start per task, and allows only the batch sizes whose growth
+    fits into the available system memory minus min_available_memory_percent
+    of the total.
+    """
+
+    # Seconds between two RSS samples taken during a batch
+    rss_sampling_interval: float = 0.01
+
+    def __init__(
+        self, min_available_memory_percent: float = 10, **kwargs: object
+    ) -> None:
+        super().__init__(**kwargs)  # type: ignore[arg-type]
+        self.__min_available_memory_percent: float = min_available_memory_percent
+        self.__start_rss: int = 0
+        self.__start_peak_rss: int = 0
+        self.__batch_peak_rss: int = 0
+        self.__sampling_stop_event: threading.Event | None = None
+        self.__sampling_thread: threading.Thread | None = None
+        # The largest peak RSS growth per task, decayed by the smoothing factor
+        self.__memory_per_task: float = 0
+        self.__max_allowed_batch_size: int = self.max_batch_size
+
+    def is_batch_size_allowed(self, batch_size: int) -> bool:
+        return (
+            super().is_batch_size_allowed(batch_size)
+            and batch_size <= self.__max_allowed_batch_size
+        )
+
+    def explore_batch_size(self, initial_batch_size: int) -> int:
+        return min(
+            super().explore_batch_size(initial_batch_size),
+            max(self.__max_allowed_batch_size, 1),
+        )
+
+    def _start_batch(self) -> None:
+        self.__start_rss = psutil.Process().memory_info().rss
+        self.__start_peak_rss = _get_peak_rss()
+        self.__batch_peak_rss = self.__start_rss
+        # The RSS after the batch misses what the batch freed before its end.
+        self.__sampling_stop_event = threading.Event()
+        self.__sampling_thread = threading.Thread(
+            name="RSS sampling", target=self.__sample_rss, daemon=True
+        )
+        self.__sampling_thread.start()
+        super()._start_batch()
+
+    def __sample_rss(self) -> None:
+        stop_event = self.__sampling_stop_event
+        assert stop_event is not None
+        process = psutil.Process()
+        while not stop_event.wait(self.rss_sampling_interval):
+            self.__batch_peak_rss = max(
+                self.__batch_peak_rss, process.memory_info().rss
+            )
+
+    def __stop_sampling(self) -> int:
+        """Stop sampling and return the peak RSS of the batch."""
+        assert (
+            self.__sampling_stop_event is not None
+            and self.__sampling_thread is not None
+        )
+        self.__sampling_stop_event.set()
+        self.__sampling_thread.join()
+        self.__sampling_stop_event = None
+        self.__sampling_thread = None
+        peak_rss = max(self.__batch_peak_rss, psutil.Process().memory_info().rss)
+        # The peak of the process is exact if the batch has raised it.
+        if (process_peak_rss := _get_peak_rss()) > self.__start_peak_rss:
+            peak_rss = max(peak_rss, process_peak_rss)
+        return peak_rss
+
+    def _cancel_batch(self) -> None:
+        self.__stop_sampling()
+        super()._cancel_batch()
+
+    def _end_batch(self) -> None:
+        assert self._current_batch_size is not None
+        memory_growth = self.__stop_sampling() - self.__start_rss
+        self.__memory_per_task = max(
+            memory_growth / self._current_batch_size,
+            self.__memory_per_task * (1 - self.smoothing_factor),
+        )
+        super()._end_batch()
+        memory = psutil.virtual_memory()
+        headroom = (
+            memory.available - memory.total * self.__min_available_memory_percent / 100
+        )
+        if headroom <= 0:
+            self.__max_allowed_batch_size = 1
+        elif self.__memory_per_task > 0:
+            self.__max_allowed_batch_size = max(
+                1, int(headroom / self.__memory_per_task)
+            )
+        else:
+            self.__max_allowed_batch_size = self.max_batch_size
+        log_debug("memory allows batch size %s", self.__max_allowed_batch_size)
+
 
 class _SentinelTask:
     pass
 
 
+class _DataBatch:
+    def __init__(self, data_list: list) -> None:
+        self.data_list = data_list
+
+
+class _TrackedTask:
+    def __init__(self, task_id: int, task: object) -> None:
+        self.task_id = task_id
+        self.task = task
+        self.attempt = 0
+
+
+class _DeadlineTask:
+    def __init__(self, task: object, deadline: float) -> None:
+        self.task = task
+        self.deadline = deadline
+
+
+class _WorkerEvent(StrEnum):
+    Heartbeat = auto()
+    Lease = auto()
+    Ack = auto()
+
+
+class _WorkerMessage:
+    def __init__(
+        self, worker_id: int, event: _WorkerEvent, task_ids: list[int] | None = None
+    ) -> None:
+        self.worker_id = worker_id
+        self.event = event
+        self.task_ids = task_ids or []
+
+
+class _SpilledData:
+    # Sent through the queue in place of data saved to path
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+
+class _SerializedData:
+    # Sent through the queue in place of data serialized by a Serializer
+    def __init__(self, frames: list) -> None:
+        self.frames = frames
+
+    def __reduce_ex__(self, protocol: int) -> tuple:  # type: ignore[override]
+        # Protocol 5 writes the frames into the pickle without copying them
+        # first, older protocols copy bytearray and keep it writable.
+        if protocol >= 5:
+            frames = [pickle.PickleBuffer(frame) for frame in self.frames]
+        else:
+            frames = [
+                frame if isinstance(frame, bytes) else bytearray(frame)
+                for frame in self.frames
+            ]
+        return type(self), (frames,)
+
+
+class _SizeLimitedWriter:
+    # Measures pickles without keeping them, giving up once over the limit
+    def __init__(self, limit: int) -> None:
+        self.__limit = limit
+        self.__size = 0
+
+    def write(self, data: bytes) -> int:
+        size = memoryview(data).nbytes
+        self.__size += size
+        if self.__size > self.__limit:
+            raise OverflowError
+        return size
+
+
+class _TaggedTask:
+    def __init__(self, sequence_id: int, task: object) -> None:
+        self.sequence_id = sequence_id
+        self.task = task
+
+
+class _TaggedResult:
+    def __init__(
+        self,
+        sequence_id: int,
+        result: object = None,
+        exception: BaseException | None = None,
+    ) -> None:
+        self.sequence_id = sequence_id
+        if isinstance(result, RepeatedResult):
+            result = result.get_data_list()
+        self.result = result
+        self.exception = exception
+
+
 class RepeatedResult:
+    """A result repeated num times.
+
+    TaskQueue sends it as a single message and the receiver takes the
+    copies one by one, so data is pickled once. With copy_data=False the
+    receivers share data and must not modify it.
+    """
+
     def __init__(self, data: object, num: int, copy_data: bool = True) -> None:
         self.__data = data
         self.__num = num
         self.__copy_data = copy_data
 
+    def __len__(self) -> int:
+        return self.__num
+
     def get_data_list(self) -> list[object]:
         return [self.data for _ in range(self.__num)]
 
+    def pop_data(self) -> object:
+        assert self.__num > 0
+        self.__num -= 1
+        return self.data
+
     def set_data(self, data: object) -> None:
         self.__data = data
 
@@ -162,35 +631,88 @@ class Worker:
         worker_id: int,
         **kwargs: object,
     ) -> None:
-        while not task_queue.stopped:
-            try:
-                if self.process(task_queue, worker_id=worker_id, **kwargs):
-                    break
-            # pylint: disable=broad-exception-caught
-            except Exception as e:
-                if not psutil.pid_exists(ppid):
-                    log_error("exit because parent process %s has died", ppid)
+        if task_queue.worker_init is not None:
+            kwargs["state"] = call_fun(task_queue.worker_init, {"worker_id": worker_id})
+        heartbeat_stop_event = threading.Event()
+        if task_queue.heartbeat_interval is not None:
+            threading.Thread(
+                name="heartbeat",
+                target=task_queue.send_heartbeats,
+                kwargs={"worker_id": worker_id, "stop_event": heartbeat_stop_event},
+                daemon=True,
+            ).start()
+        try:
+            while not task_queue.stopped:
+                try:
+                    end_process = self.process(
+                        task_queue, worker_id=worker_id, **kwargs
+                    )
+                # pylint: disable=broad-exception-caught
+                except Exception as e:
+                    if not psutil.pid_exists(ppid):
+                        log_error("exit because parent process %s has died", ppid)
+                        return
+                    # A stop that timed out has removed the queues
+                    if task_queue.stopped:
+                        return
+                    log_error("catch exception:%s", e)
+                    log_error("traceback:%s", traceback.format_exc())
+                    log_error("end worker on exception")
                     return
-                log_error("catch exception:%s", e)
-                log_error("traceback:%s", traceback.format_exc())
-                log_error("end worker on exception")
-                return
-        task_queue.clear_data(task_queue.get_worker_queue_name(worker_id))
+                task_queue.ack_tasks(worker_id)
+                if end_process:
+                    break
+            task_queue.clear_data(task_queue.get_worker_queue_name(worker_id))
+        finally:
+            heartbeat_stop_event.set()
+            if task_queue.worker_teardown is not None:
+                call_fun(
+                    task_queue.worker_teardown,
+                    {"state": kwargs.get("state"), "worker_id": worker_id},
+                )
 
-    def _get_task(self, task_queue: "TaskQueue", timeout: float) -> Expected:
-        task = task_queue.get_task(timeout=timeout)
+    def _get_task(
+        self, task_queue: "TaskQueue", worker_id: int, timeout: float
+    ) -> Expected:
+        task = task_queue.get_task(timeout=timeout, worker_id=worker_id)
         if task.is_ok() and isinstance(task.value(), _SentinelTask):
             return Expected.not_ok()
         return task
 
+    def _get_tasks(
+        self, task_queue: "TaskQueue", worker_id: int, max_tasks: int, timeout: float
+    ) -> tuple[list, bool]:
+        tasks = task_queue.get_tasks(
+            max_tasks=max_tasks, timeout=timeout, worker_id=worker_id
+        )
+        if not tasks:
+            return tasks, True
+        if isinstance(tasks[-1], _SentinelTask):
+            return tasks[:-1], True
+        return tasks, False
+
     def process(
         self, task_queue: "TaskQueue", worker_id: int, **kwargs: object
     ) -> bool:
-        task = self._get_task(task_queue=task_queue, timeout=3600)
+        task = self._get_task(task_queue=task_queue, worker_id=worker_id, timeout=3600)
         if not task.is_ok():
             return True
+        task_value = task.value()
+        if isinstance(task_value, _TaggedTask):
+            try:
+                tagged_result = _TaggedResult(
+                    task_value.sequence_id,
+                    result=task_queue.worker_fun(
+                        task=task_value.task, **kwargs, worker_id=worker_id
+                    ),
+                )
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                tagged_result = _TaggedResult(task_value.sequence_id, exception=e)
+            task_queue.put_data(data=tagged_result, queue_name="__future_result")
+            return False
         res = task_queue.worker_fun(
-            task=task.value(),
+            task=task_value,
             **kwargs,
             worker_id=worker_id,
         )
@@ -200,10 +722,21 @@ class Worker:
 
 
 class BatchWorker(Worker):
-    def __init__(self, batch_policy: BatchPolicy) -> None:
+    def __init__(self, batch_policy: BatchPolicy, max_latency: float = 0.005) -> None:
         super().__init__()
         self.batch_size: int = 1
         self.batch_policy: BatchPolicy = batch_policy
+        # How long to wait for more tasks after the first task of a batch
+        self.max_latency: float = max_latency
+
+    def __call__(self, **kwargs: object) -> None:  # type: ignore[override]
+        # Start from what other workers and previous runs have learned.
+        self.batch_policy.sync_state(force=True)
+        self.batch_size = self.batch_policy.explore_batch_size(
+            initial_batch_size=self.batch_size
+        )
+        super().__call__(**kwargs)  # type: ignore[arg-type]
+        self.batch_policy.sync_state(force=True)
 
     def __batch_process(
         self,
@@ -221,42 +754,76 @@ class BatchWorker(Worker):
                 self.batch_policy.set_current_batch_size(batch_size=batch_size)
                 with self.batch_policy:
                     results = task_queue.worker_fun(
-                        tasks=batch,
+                        tasks=[
+                            task.task if isinstance(task, _TaggedTask) else task
+                            for task in batch
+                        ],
                         **kwargs,
                     )
                 self.batch_size = self.batch_policy.explore_batch_size(
                     initial_batch_size=batch_size
                 )
-                assert batch_size <= self.batch_size
                 log_debug("new batch_size is %s", self.batch_size)
                 tasks = tasks[len(batch) :]
-            except BaseException:
+            except BaseException as e:
                 log_error("Got exception", exc_info=True)
                 if (
                     isinstance(self.batch_policy, RetryableBatchPolicy)
+                    and self.batch_policy.is_retryable(e)
                     and batch_size > 1
                 ):
-                    batch_size -= 1
+                    batch_size //= 2
                     continue
-                else:
+                if not all(isinstance(task, _TaggedTask) for task in batch):
                     raise
+                # The submitters get the exception through their futures.
+                task_queue.put_many(
+                    [_TaggedResult(task.sequence_id, exception=e) for task in batch],  # type: ignore[attr-defined]
+                    queue_name="__future_result",
+                )
+                tasks = tasks[len(batch) :]
+                continue
             assert results is None or len(results) == len(batch)
-            if results is not None:
-                for result in results:
-                    task_queue.put_data(data=result, queue_name="__result")
-
-    def __collect_tasks(self, task_queue: "TaskQueue") -> tuple[list, bool]:
-        end_process = False
-        tasks = []
-        for idx in range(self.batch_size):
-            if idx == 0:
-                task = self._get_task(task_queue=task_queue, timeout=3600)
-            else:
-                task = self._get_task(task_queue=task_queue, timeout=0.000001)
-            if not task.is_ok():
-                end_process = True
+            self.__put_results(task_queue=task_queue, batch=batch, results=results)
+
+    def __put_results(
+        self, task_queue: "TaskQueue", batch: list, results: list | None
+    ) -> None:
+        tagged_results: list = []
+        untagged_results: list = []
+        for idx, task in enumerate(batch):
+            result = None if results is None else results[idx]
+            if isinstance(task, _TaggedTask):
+                tagged_results.append(_TaggedResult(task.sequence_id, result=result))
+            elif results is not None:
+                untagged_results.append(result)
+        task_queue.put_many(tagged_results, queue_name="__future_result")
+        task_queue.put_many(untagged_results, queue_name="__result")
+
+    def __collect_tasks(
+        self, task_queue: "TaskQueue", worker_id: int
+    ) -> tuple[list, bool]:
+        tasks, end_process = self._get_tasks(
+            task_queue=task_queue,
+            worker_id=worker_id,
+            max_tasks=self.batch_size,
+            timeout=3600,
+        )
+        # Fill the batch until it is full or the first task has waited long enough.
+        deadline = time.monotonic() + self.max_latency
+        while not end_process and len(tasks) < self.batch_size:
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
                 break
-            tasks.append(task.value())
+            more_tasks = task_queue.get_tasks(
+                max_tasks=self.batch_size - len(tasks),
+                timeout=remaining_time,
+                worker_id=worker_id,
+            )
+            if more_tasks and isinstance(more_tasks[-1], _SentinelTask):
+                more_tasks.pop()
+                end_process = True
+            tasks += more_tasks
         return tasks, end_process
 
     def process(
@@ -266,7 +833,9 @@ class BatchWorker(Worker):
         **kwargs: object,
     ) -> bool:
         assert self.batch_size > 0
-        tasks, end_process = self.__collect_tasks(task_queue=task_queue)
+        tasks, end_process = self.__collect_tasks(
+            task_queue=task_queue, worker_id=worker_id
+        )
         if tasks:
             self.__batch_process(
                 tasks=tasks, task_queue=task_queue, worker_id=worker_id, **kwargs
@@ -274,22 +843,157 @@ class BatchWorker(Worker):
         return end_process
 
 
+@dataclass(kw_only=True)
+class TaskQueueOptions:
+    """How a TaskQueue queues, schedules and transfers its tasks."""
+
+    # The task and result queues can't be pipes
+    queue_type: QueueType = QueueType.Queue
+    scheduling_mode: SchedulingMode = SchedulingMode.Shared
+    worker_scaling_policy: WorkerScalingPolicy | None = None
+    # Every worker receives the queues of keyed tasks, of prioritized tasks
+    # and of the results of submit(), so they are only created for the
+    # features enabled here. Work stealing and worker scaling always have the
+    # queues of keyed tasks, and deduplicate_tasks implies use_futures.
+    use_task_keys: bool = False
+    use_task_priorities: bool = False
+    use_futures: bool = False
+    # Bounds the task queues so that producers wait for slow workers,
+    # unlimited if not positive.
+    task_queue_maxsize: int = 0
+    max_batch_latency: float = 0.005
+    # Batch policies persist their state here, or share it through a
+    # temporary directory removed on stop.
+    batch_policy_state_dir: str | None = None
+    # If task_retry_limit is set, the tasks of a dead worker are added
+    # again up to task_retry_limit times and a new worker replaces it.
+    # Workers also send heartbeats, and a worker process silent for
+    # heartbeat_timeout seconds is terminated.
+    task_retry_limit: int | None = None
+    heartbeat_interval: float = 1
+    heartbeat_timeout: float = 30
+    # Put an ExpiredTask into __result for a task past its deadline
+    # instead of dropping it
+    flag_expired_tasks: bool = False
+    # submit() returns the Future of an identical task still queued or
+    # running instead of adding the task again
+    deduplicate_tasks: bool = False
+    # Data pickling to more than spill_threshold bytes is saved to a file
+    # in spill_dir, or the temporary directory, and the queues carry its
+    # path. The receiver loads and removes the file.
+    spill_threshold: int | None = None
+    spill_dir: str | None = None
+    # Bytes of the ring buffer of each shared memory queue, 16 MiB by
+    # default. Larger data is saved to a file in spill_dir like spilled data.
+    shared_memory_capacity: int | None = None
+    # Serialize data with serializer instead of the default pickling of
+    # multiprocessing. Shared memory queues write its out-of-band buffers
+    # straight into shared memory.
+    serializer: Serializer | None = None
+
+    def __post_init__(self) -> None:
+        if self.queue_type == QueueType.Pipe:
+            # Several workers would read and write both ends of a pipe without
+            # a lock, and with no flow control a full pipe blocks both sides.
+            raise ValueError("task and result queues can't be pipes")
+
+
 class TaskQueue:
+    # Seconds between two looks of a worker at the task queues in use
+    __queue_usage_check_interval: float = 0.1
+
     def __init__(
         self,
         mp_ctx: ConcurrencyContext,
         worker_num: int = 1,
         batch_policy_type: type[BatchPolicy] | None = None,
+        *,
+        options: TaskQueueOptions | None = None,
     ) -> None:
         self.__mp_ctx = mp_ctx
+        self.__options: TaskQueueOptions = (
+            TaskQueueOptions() if options is None else options
+        )
+        if self.__options.worker_scaling_policy is not None:
+            worker_num = self.__options.worker_scaling_policy.clamp(worker_num)
         self.__worker_num: int = worker_num
         self.__worker_fun: Callable | None = None
+        self.__worker_init: Callable | None = None
+        self.__worker_teardown: Callable | None = None
         self.__workers: None | dict = None
         self.__batch_policy_type = batch_policy_type
         self.__stop_event: (
             threading.Event | multiprocessing.synchronize.Event | None
         ) = None
         self.__queues: dict = {}
+        # Queues shared with and owned by another TaskQueue
+        self.__linked_queue_names: set[str] = set()
+        self.__has_worker_queues: bool = (
+            self.__options.use_task_keys
+            or self.__options.scheduling_mode == SchedulingMode.WorkStealing
+            or self.__options.worker_scaling_policy is not None
+        )
+        # Tasks without key, priority and deadline go straight into __task
+        # unless they are tracked for retries.
+        self.__puts_plain_tasks_directly: bool = (
+            self.__options.task_retry_limit is None
+            and self.__options.scheduling_mode == SchedulingMode.Shared
+        )
+        # Data put for other processes may be serialized or spilled to files.
+        self.__encodes_data: bool = not mp_ctx.in_thread() and (
+            self.__options.serializer is not None
+            or self.__options.spill_threshold is not None
+        )
+        # Without the other task queues, workers block on __task alone.
+        self.__takes_plain_tasks_only: bool = (
+            self.__puts_plain_tasks_directly
+            and not self.__has_worker_queues
+            and not self.__options.use_task_priorities
+        )
+        # Workers take tasks from __task only until keyed or prioritized
+        # tasks are added, which the events tell other processes.
+        self.__worker_queues_in_use: bool = (
+            self.__options.worker_scaling_policy is not None
+        )
+        self.__priority_queues_in_use: bool = False
+        self.__worker_queues_event: (
+            threading.Event | multiprocessing.synchronize.Event | None
+        ) = None
+        self.__priority_queues_event: (
+            threading.Event | multiprocessing.synchronize.Event | None
+        ) = None
+        self.__next_queue_usage_check_time: float = 0
+        self.__batch_policy_temp_dir: str | None = None
+        self.__task_ids = itertools.count()
+        # task id -> (task, key, priority)
+        self.__unacked_tasks: dict[int, tuple[_TrackedTask, object, TaskPriority]] = {}
+        # worker id -> ids of the tasks the worker is processing
+        self.__leases: dict[int, set[int]] = {}
+        # The leases taken by the workers in this process, not yet acknowledged
+        self.__local_leases: dict[int, list[int]] = {}
+        self.__heartbeat_times: dict[int, float] = {}
+        self.__monitor_thread: threading.Thread | None = None
+        self.__monitor_stop_event: threading.Event | None = None
+        self.__next_worker_id: int = 0
+        self.__worker_lock: threading.RLock = threading.RLock()
+        self.__retired_workers: dict = {}
+        self.__use_thread: bool = False
+        self.__scaling_thread: threading.Thread | None = None
+        self.__scaling_stop_event: threading.Event | None = None
+        self.__futures: dict[int, concurrent.futures.Future] = {}
+        # task fingerprint -> Future
+        self.__inflight_futures: dict[bytes, concurrent.futures.Future] = {}
+        self.__inflight_lock: threading.Lock = threading.Lock()
+        self.__sequence_ids = itertools.count()
+        self.__dispatch_thread: threading.Thread | None = None
+        self.__dispatch_stop_event: threading.Event | None = None
+        # Delayed and periodic tasks wait here until they are due
+        self.__timer_wheel: TimerWheel = TimerWheel()
+        self.__timer_condition: threading.Condition = threading.Condition()
+        self.__timer_thread: threading.Thread | None = None
+        self.__timer_stop_event: threading.Event | None = None
+        self.__pending_data: dict[str, collections.deque] = {}
+        self.__pending_lock: threading.Lock = threading.Lock()
         self.__set_logger: bool = True
 
     @property
@@ -316,69 +1020,576 @@ class TaskQueue:
         # capture what is normally dilld
         state = self.__dict__.copy()
         state["_TaskQueue__workers"] = None
+        state["_TaskQueue__pending_data"] = {}
+        state["_TaskQueue__worker_lock"] = None
+        state["_TaskQueue__pending_lock"] = None
+        state["_TaskQueue__retired_workers"] = {}
+        state["_TaskQueue__scaling_thread"] = None
+        state["_TaskQueue__scaling_stop_event"] = None
+        state["_TaskQueue__futures"] = {}
+        state["_TaskQueue__inflight_futures"] = {}
+        state["_TaskQueue__inflight_lock"] = None
+        state["_TaskQueue__sequence_ids"] = None
+        state["_TaskQueue__dispatch_thread"] = None
+        state["_TaskQueue__dispatch_stop_event"] = None
+        state["_TaskQueue__task_ids"] = None
+        state["_TaskQueue__unacked_tasks"] = {}
+        state["_TaskQueue__leases"] = {}
+        state["_TaskQueue__local_leases"] = {}
+        state["_TaskQueue__heartbeat_times"] = {}
+        state["_TaskQueue__monitor_thread"] = None
+        state["_TaskQueue__monitor_stop_event"] = None
+        state["_TaskQueue__timer_wheel"] = None
+        state["_TaskQueue__timer_condition"] = None
+        state["_TaskQueue__timer_thread"] = None
+        state["_TaskQueue__timer_stop_event"] = None
         return state
 
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.__worker_lock = threading.RLock()
+        self.__pending_lock = threading.Lock()
+        self.__inflight_lock = threading.Lock()
+        self.__timer_wheel = TimerWheel()
+        self.__timer_condition = threading.Condition()
+
+    @property
+    def __uses_futures(self) -> bool:
+        return self.__options.use_futures or self.__options.deduplicate_tasks
+
+    @property
+    def heartbeat_interval(self) -> float | None:
+        if self.__options.task_retry_limit is None:
+            return None
+        return self.__options.heartbeat_interval
+
+    @property
+    def max_worker_num(self) -> int:
+        if self.__options.worker_scaling_policy is not None:
+            return self.__options.worker_scaling_policy.max_worker_num
+        return self.__worker_num
+
     @property
     def worker_fun(self) -> Callable:
         assert self.__worker_fun is not None
         return self.__worker_fun
 
-    def add_queue(self, name: str, queue_type: QueueType) -> None:
+    @property
+    def worker_init(self) -> Callable | None:
+        return self.__worker_init
+
+    @property
+    def worker_teardown(self) -> Callable | None:
+        return self.__worker_teardown
+
+    def add_queue(
+        self,
+        name: str,
+        queue_type: QueueType,
+        maxsize: int = 0,
+        capacity: int | None = None,
+    ) -> None:
+        """Add a queue, maxsize bounds the queue unless it is a pipe.
+
+        capacity is the size in bytes of a shared memory queue, the
+        shared_memory_capacity of the options by default.
+        """
         assert name not in self.__queues
         if queue_type == QueueType.Pipe and self.mp_ctx.support_pipe():
             self.__queues[name] = (self.mp_ctx.create_pipe(), QueueType.Pipe)
+        elif (
+            queue_type == QueueType.SharedMemory and self.mp_ctx.support_shared_memory()
+        ):
+            self.__queues[name] = (
+                self.mp_ctx.create_shared_memory_queue(
+                    maxsize=maxsize,
+                    serializer=self.__options.serializer,
+                    capacity=self.__options.shared_memory_capacity
+                    if capacity is None
+                    else capacity,
+                ),
+                QueueType.SharedMemory,
+            )
         else:
-            self.__queues[name] = (self.mp_ctx.create_queue(), QueueType.Queue)
+            self.__queues[name] = (
+                self.mp_ctx.create_queue(maxsize=maxsize),
+                QueueType.Queue,
+            )
+
+    def link_queue(self, name: str, other: "TaskQueue", other_name: str) -> None:
+        """Use the queue other_name of other as the queue name.
+
+        For example, linking __result to the __task queue of other makes the
+        workers put their results straight into the tasks of other. The queue
+        stays owned by other, which closes it on stop.
+        """
+        assert name not in self.__queues
+        if (
+            other_name == "__task"
+            and other.__options.scheduling_mode == SchedulingMode.WorkStealing
+        ):
+            raise ValueError("workers stealing tasks don't read __task")
+        self.__queues[name] = other.__get_queue(other_name)
+        self.__linked_queue_names.add(name)
 
     def __get_queue(self, name: str) -> tuple:
         return self.__queues[name]
 
     def start(
-        self, worker_fun: Callable | None = None, use_thread: bool = False
+        self,
+        worker_fun: Callable | None = None,
+        use_thread: bool = False,
+        worker_init: Callable | None = None,
+        worker_teardown: Callable | None = None,
     ) -> None:
+        """Start the workers.
+
+        Each worker calls worker_init once, with worker_id if it takes one,
+        and passes the return value to worker_fun as the state argument. On
+        exit the worker calls worker_teardown with state and worker_id if it
+        takes them.
+        """
         self.stop()
         if worker_fun is not None:
             self.__worker_fun = worker_fun
+        if worker_init is not None:
+            self.__worker_init = worker_init
+        if worker_teardown is not None:
+            self.__worker_teardown = worker_teardown
         assert self.__worker_num > 0
         assert self.__worker_fun is not None
         if self.__stop_event is None:
             self.__stop_event = self.mp_ctx.create_event()
-        if not self.__queues:
-            self.__queues = {}
-        if "__task" not in self.__queues:
-            self.add_queue("__task", queue_type=QueueType.Queue)
-        if "__result" not in self.__queues:
-            self.add_queue("__result", queue_type=QueueType.Queue)
-
+        if self.__has_worker_queues and self.__worker_queues_event is None:
+            self.__worker_queues_event = self.mp_ctx.create_event()
+        if self.__options.use_task_priorities and self.__priority_queues_event is None:
+            self.__priority_queues_event = self.mp_ctx.create_event()
+        self.__add_missing_queues()
         if not self.__workers:
             assert self.__stop_event is not None
             self.__stop_event.clear()
+            if self.__worker_queues_event is not None:
+                self.__worker_queues_event.clear()
+            if self.__priority_queues_event is not None:
+                self.__priority_queues_event.clear()
+            self.__worker_queues_in_use = (
+                self.__options.worker_scaling_policy is not None
+            )
+            self.__priority_queues_in_use = False
             self.__workers = {}
+        self.__use_thread = use_thread
         for _ in range(len(self.__workers), self.__worker_num):
-            worker_id = max(self.__workers.keys(), default=-1) + 1
+            worker_id = min(set(range(self.max_worker_num)) - set(self.__workers))
             self._start_worker(worker_id, use_thread=use_thread)
+        if self.__options.worker_scaling_policy is not None:
+            self.__scaling_stop_event = threading.Event()
+            self.__scaling_thread = threading.Thread(
+                name="worker scaling", target=self.__scale_workers, daemon=True
+            )
+            self.__scaling_thread.start()
+        if self.__options.task_retry_limit is not None:
+            self.__monitor_stop_event = threading.Event()
+            self.__monitor_thread = threading.Thread(
+                name="worker monitoring", target=self.__monitor_workers, daemon=True
+            )
+            self.__monitor_thread.start()
 
-    def put_data(self, data: object | RepeatedResult, queue_name: str) -> None:
-        queue, queue_type = self.__get_queue(queue_name)
-        data_list: list = [data]
+    def __add_missing_queues(self) -> None:
+        if not self.__queues:
+            self.__queues = {}
+        task_queue_names = ["__task"]
+        if self.__options.use_task_priorities:
+            task_queue_names += self.__get_priority_queue_names()
+        if self.__has_worker_queues:
+            task_queue_names += [
+                self.get_worker_queue_name(worker_id)
+                for worker_id in range(self.max_worker_num)
+            ]
+        for queue_name in task_queue_names:
+            if queue_name not in self.__queues:
+                self.add_queue(
+                    queue_name,
+                    queue_type=self.__options.queue_type,
+                    maxsize=self.__options.task_queue_maxsize,
+                )
+        if "__result" not in self.__queues:
+            self.add_queue("__result", queue_type=self.__options.queue_type)
+        if self.__uses_futures and "__future_result" not in self.__queues:
+            self.add_queue("__future_result", queue_type=self.__options.queue_type)
+        if (
+            self.__options.task_retry_limit is not None
+            and "__control" not in self.__queues
+        ):
+            # Unlike multiprocessing.Queue, a put into shared memory has
+            # completed when it returns, so a lease survives a crash right
+            # after it.
+            self.add_queue("__control", queue_type=QueueType.SharedMemory)
+
+    def send_heartbeats(self, worker_id: int, stop_event: threading.Event) -> None:
+        assert self.heartbeat_interval is not None
+        while not stop_event.wait(self.heartbeat_interval):
+            self.put_data(
+                _WorkerMessage(worker_id, _WorkerEvent.Heartbeat),
+                queue_name="__control",
+            )
+
+    def ack_tasks(self, worker_id: int) -> None:
+        """Acknowledge the tasks the worker has taken, they won't be redelivered."""
+        task_ids = self.__local_leases.pop(worker_id, None)
+        if task_ids:
+            self.put_data(
+                _WorkerMessage(worker_id, _WorkerEvent.Ack, task_ids),
+                queue_name="__control",
+            )
+
+    def __lease_tasks(self, tasks: list, worker_id: int) -> list:
+        task_ids = [task.task_id for task in tasks if isinstance(task, _TrackedTask)]
+        if not task_ids:
+            return tasks
+        self.__local_leases.setdefault(worker_id, []).extend(task_ids)
+        self.put_data(
+            _WorkerMessage(worker_id, _WorkerEvent.Lease, task_ids),
+            queue_name="__control",
+        )
+        return [task.task if isinstance(task, _TrackedTask) else task for task in tasks]
+
+    def __monitor_workers(self) -> None:
+        stop_event = self.__monitor_stop_event
+        assert stop_event is not None
+        while not stop_event.is_set():
+            for message in self.get_many(
+                max_items=1024,
+                timeout=self.__options.heartbeat_interval,
+                queue_name="__control",
+            ):
+                self.__handle_worker_message(message)
+            if self.stopped:
+                continue
+            with self.__worker_lock:
+                assert self.__workers is not None
+                for worker_id, worker in list(self.__workers.items()):
+                    if worker.is_alive():
+                        if isinstance(worker, threading.Thread) or (
+                            time.monotonic()
+                            - self.__heartbeat_times.get(worker_id, time.monotonic())
+                            < self.__options.heartbeat_timeout
+                        ):
+                            continue
+                        log_error("worker %s stops sending heartbeats", worker_id)
+                        worker.terminate()
+                    self.__replace_worker(worker_id)
+
+    def __handle_worker_message(self, message: _WorkerMessage) -> None:
+        self.__heartbeat_times[message.worker_id] = time.monotonic()
+        match message.event:
+            case _WorkerEvent.Lease:
+                self.__leases.setdefault(message.worker_id, set()).update(
+                    message.task_ids
+                )
+            case _WorkerEvent.Ack:
+                leases = self.__leases.get(message.worker_id, set())
+                for task_id in message.task_ids:
+                    leases.discard(task_id)
+                    self.__unacked_tasks.pop(task_id, None)
+
+    def __replace_worker(self, worker_id: int) -> None:
+        assert self.__workers is not None
+        worker = self.__workers.pop(worker_id)
+        worker.join()
+        log_error(
+            "worker %s exited unexpectedly with exit code %s",
+            worker_id,
+            getattr(worker, "exitcode", None),
+        )
+        task_ids = self.__leases.pop(worker_id, set())
+        if not isinstance(worker, threading.Thread):
+            # The process may have died after taking tasks but before leasing
+            # them.
+            task_ids |= self.__find_lost_tasks()
+        for task_id in sorted(task_ids):
+            if task_id not in self.__unacked_tasks:
+                continue
+            tracked_task, key, priority = self.__unacked_tasks[task_id]
+            assert self.__options.task_retry_limit is not None
+            if tracked_task.attempt >= self.__options.task_retry_limit:
+                log_error(
+                    "drop task %s after %s attempts", task_id, tracked_task.attempt + 1
+                )
+                self.__unacked_tasks.pop(task_id)
+                if isinstance(tracked_task.task, _TaggedTask):
+                    self.put_data(
+                        _TaggedResult(
+                            tracked_task.task.sequence_id,
+                            exception=RuntimeError(
+                                f"worker {worker_id} died while running the task"
+                            ),
+                        ),
+                        queue_name="__future_result",
+                    )
+                continue
+            tracked_task.attempt += 1
+            self.put_data(
+                tracked_task,
+                queue_name=self.__next_task_queue_name(key=key, priority=priority),
+            )
+        self._start_worker(worker_id, use_thread=self.__use_thread)
+
+    def __find_lost_tasks(self) -> set[int]:
+        """Return the unacknowledged tasks neither queued nor leased.
+
+        The task queues are drained and refilled to find the queued tasks. A
+        live worker taking a task meanwhile may have its task returned too, so
+        the task can run twice.
+        """
+        self.__handle_pending_worker_messages()
+        queued_task_ids: set[int] = set()
+        for queue_name in self.__get_all_task_queue_names():
+            data_list: list = []
+            # qsize counts the data still held by the feeder thread of
+            # multiprocessing.Queue.
+            while self.__get_queue_size(queue_name) > 0:
+                data_list += self.get_many(
+                    max_items=1024, timeout=0.01, queue_name=queue_name
+                )
+            queued_task_ids.update(
+                data.task_id for data in data_list if isinstance(data, _TrackedTask)
+            )
+            for data in data_list:
+                self.put_data(data, queue_name=queue_name)
+        # Leases sent while the queues were drained
+        self.__handle_pending_worker_messages()
+        leased_task_ids = set().union(*self.__leases.values())
+        return {
+            task_id
+            for task_id in self.__unacked_tasks
+            if task_id not in queued_task_ids and task_id not in leased_task_ids
+        }
+
+    def __handle_pending_worker_messages(self) -> None:
+        while messages := self.get_many(
+            max_items=1024, timeout=0, queue_name="__control"
+        ):
+            for message in messages:
+                self.__handle_worker_message(message)
+
+    @property
+    def task_backlog(self) -> int:
+        return sum(
+            self.__get_queue_size(queue_name)
+            for queue_name in self.__get_all_task_queue_names()
+        )
+
+    def __get_queue_size(self, queue_name: str) -> int:
+        size = len(self.__pending_data.get(queue_name, ()))
+        q, queue_type = self.__get_queue(queue_name)
+        if queue_type == QueueType.Pipe:
+            return size + int(q[1].poll())
+        try:
+            return size + q.qsize()
+        except NotImplementedError:
+            return size + int(not q.empty())
+
+    def __scale_workers(self) -> None:
+        policy = self.__options.worker_scaling_policy
+        stop_event = self.__scaling_stop_event
+        assert policy is not None and stop_event is not None
+        last_busy_time = time.monotonic()
+        while not stop_event.wait(policy.interval):
+            self.__reap_retired_workers()
+            task_backlog = self.task_backlog
+            if task_backlog > 0:
+                last_busy_time = time.monotonic()
+            worker_num = policy.get_worker_num(
+                worker_num=self.__worker_num,
+                task_backlog=task_backlog,
+                idle_seconds=time.monotonic() - last_busy_time,
+            )
+            if worker_num > self.__worker_num:
+                self.__add_worker()
+            elif worker_num < self.__worker_num:
+                self.__retire_worker()
+                last_busy_time = time.monotonic()
+
+    def __add_worker(self) -> None:
+        with self.__worker_lock:
+            assert self.__workers is not None
+            # Keyed tasks are hashed over worker ids 0..worker_num-1, so the new
+            # worker takes the next id once its previous owner has exited.
+            worker_id = self.__worker_num
+            if worker_id in self.__retired_workers:
+                return
+            log_debug("add worker %s", worker_id)
+            self._start_worker(worker_id, use_thread=self.__use_thread)
+            self.__worker_num += 1
+
+    def __retire_worker(self) -> None:
+        with self.__worker_lock:
+            assert self.__workers is not None
+            worker_id = self.__worker_num - 1
+            log_debug("retire worker %s", worker_id)
+            self.__worker_num -= 1
+            self.__retired_workers[worker_id] = self.__workers.pop(worker_id)
+            # The worker finishes the tasks already in its queue before exiting.
+            self.__put_data(
+                _SentinelTask(), queue_name=self.get_worker_queue_name(worker_id)
+            )
+
+    def __reap_retired_workers(self) -> None:
+        with self.__worker_lock:
+            for worker_id, worker in list(self.__retired_workers.items()):
+                if not worker.is_alive():
+                    worker.join()
+                    self.__retired_workers.pop(worker_id)
+
+    def put_data(
+        self,
+        data: object | RepeatedResult,
+        queue_name: str,
+        block: bool = True,
+        timeout: float | None = None,
+    ) -> None:
         if isinstance(data, RepeatedResult):
-            data_list = data.get_data_list()
+            if len(data) == 0:
+                return
+            if not self.__has_single_consumer(queue_name):
+                self.put_many(
+                    data.get_data_list(),
+                    queue_name=queue_name,
+                    block=block,
+                    timeout=timeout,
+                )
+                return
+        self.__put_data(data, queue_name=queue_name, block=block, timeout=timeout)
 
+    def put_many(
+        self,
+        data_list: Iterable[object],
+        queue_name: str,
+        block: bool = True,
+        timeout: float | None = None,
+    ) -> None:
+        """Put the data, as one message if the queue has a single consumer.
+
+        The receiving side unpacks a batch and the RepeatedResults in it in
+        get_data/get_many. Data for other queues, such as the task queues, is
+        put one by one so that every consumer gets its share, and if a
+        bounded queue fills up, the data put before stays queued.
+        """
+        flattened_data_list: list = [
+            data
+            for data in data_list
+            if not isinstance(data, RepeatedResult) or len(data) > 0
+        ]
+        if len(flattened_data_list) > 1 and self.__has_single_consumer(queue_name):
+            flattened_data_list = [_DataBatch(flattened_data_list)]
+        for data in flattened_data_list:
+            self.put_data(data, queue_name=queue_name, block=block, timeout=timeout)
+
+    def __has_single_consumer(self, queue_name: str) -> bool:
+        # The process taking a batch unpacks it locally, so only the queues
+        # read by the process owning this TaskQueue take batches. A linked
+        # queue may be the task queue of another TaskQueue.
+        return (
+            queue_name in ("__result", "__future_result", "__control")
+            and queue_name not in self.__linked_queue_names
+        )
+
+    def __put_data(
+        self,
+        data: object,
+        queue_name: str,
+        block: bool = True,
+        timeout: float | None = None,
+    ) -> None:
+        queue, queue_type = self.__get_queue(queue_name)
+        if self.__encodes_data:
+            if (
+                self.__options.serializer is not None
+                and queue_type != QueueType.SharedMemory
+            ):
+                data = _SerializedData(self.__options.serializer.dumps_frames(data))
+            if self.__options.spill_threshold is not None:
+                data = self.__spill_data(data)
         if queue_type == QueueType.Pipe:
-            for a in data_list:
-                queue[0].send(a)
+            if isinstance(data, _SerializedData):
+                # The frames are sent as they are instead of pickled again.
+                for frame in data.frames:
+                    queue[0].send_bytes(frame)
+            else:
+                queue[0].send(data)
+        elif queue_type == QueueType.SharedMemory:
+            try:
+                queue.put(data, block=block, timeout=timeout)
+            except MessageTooLargeError:
+                # Failing would end the worker putting its result.
+                queue.put(self.__save_data(data), block=block, timeout=timeout)
+        else:
+            queue.put(data, block=block, timeout=timeout)
+
+    def __spill_data(self, data: object) -> object:
+        assert self.__options.spill_threshold is not None
+        if isinstance(data, _SerializedData) or self.__options.serializer is not None:
+            # Measured by the frames the data is sent as
+            frames = (
+                data.frames
+                if isinstance(data, _SerializedData)
+                else self.__options.serializer.dumps_frames(data)  # type: ignore[union-attr]
+            )
+            if sum(memoryview(frame).nbytes for frame in frames) <= (
+                self.__options.spill_threshold
+            ):
+                return data
         else:
-            for a in data_list:
-                queue.put(a)
+            try:
+                ForkingPickler(_SizeLimitedWriter(self.__options.spill_threshold)).dump(
+                    data
+                )
+                return data
+            except OverflowError:
+                pass
+        return self.__save_data(data)
+
+    def __save_data(self, data: object) -> _SpilledData:
+        fd, path = tempfile.mkstemp(prefix="task_queue_", dir=self.__options.spill_dir)
+        os.close(fd)
+        SyncedDataStorage(data=data, data_path=path).save()
+        return _SpilledData(path)
+
+    def __decode_data(self, data: object) -> object:
+        if isinstance(data, _SpilledData):
+            storage = SyncedDataStorage(data_path=data.path)
+            data = storage.data
+            storage.clear()
+        if isinstance(data, _SerializedData):
+            # The payload describes its own format, any serializer loads it.
+            data = (self.__options.serializer or get_default_serializer()).loads_frames(
+                data.frames
+            )
+        return data
+
+    @classmethod
+    def __receive(cls, connection: multiprocessing.connection.Connection) -> object:
+        message = connection.recv_bytes()
+        if not Serializer.is_serialized(message):
+            return ForkingPickler.loads(message)
+        # The frames follow their header, each is read into a writable buffer.
+        frames: list = [message]
+        for size in get_default_serializer().get_frame_sizes(message):
+            frame = bytearray(size)
+            connection.recv_bytes_into(frame)
+            frames.append(frame)
+        return _SerializedData(frames)
 
     def _start_worker(self, worker_id: int, use_thread: bool) -> None:
         assert self.__workers is not None and worker_id not in self.__workers
 
-        target: Worker = (
-            BatchWorker(batch_policy=self.__batch_policy_type())
-            if self.__batch_policy_type is not None
-            else Worker()
-        )
+        target: Worker = Worker()
+        if self.__batch_policy_type is not None:
+            batch_policy = self.__batch_policy_type()
+            batch_policy.set_state_file(self.__get_batch_policy_state_file())
+            target = BatchWorker(
+                batch_policy=batch_policy, max_latency=self.__options.max_batch_latency
+            )
         creator = self.mp_ctx.create_worker
         if use_thread:
             creator = self.mp_ctx.create_thread
@@ -387,9 +1598,7 @@ class TaskQueue:
             or self.mp_ctx.in_thread()
             or (
                 isinstance(self.mp_ctx, ProcessContext)
-                and isinstance(
-                    self.mp_ctx.get_ctx(), multiprocessing.context.SpawnContext
-                )
+                and self.mp_ctx.get_start_method() != "fork"
             )
         )
 
@@ -401,33 +1610,147 @@ class TaskQueue:
             args=(),
             kwargs=self._get_task_kwargs(worker_id),
         )
+        self.__heartbeat_times[worker_id] = time.monotonic()
         self.__workers[worker_id].start()
 
-    def join(self) -> None:
+    def __get_batch_policy_state_file(self) -> str:
+        state_dir = self.__options.batch_policy_state_dir
+        if state_dir is None:
+            if self.__batch_policy_temp_dir is None:
+                self.__batch_policy_temp_dir = tempfile.mkdtemp()
+            state_dir = self.__batch_policy_temp_dir
+        Path(state_dir).mkdir(parents=True, exist_ok=True)
+        worker_fun = self.worker_fun
+        while isinstance(worker_fun, functools.partial):
+            worker_fun = worker_fun.func
+        name = "{}.{}".format(
+            getattr(worker_fun, "__module__", None),
+            getattr(worker_fun, "__qualname__", type(worker_fun).__qualname__),
+        )
+        return str(Path(state_dir) / (re.sub(r"[^\w.-]", "_", name) + ".json"))
+
+    def join(
+        self, timeout: float | None = None
+    ) -> list[threading.Thread | multiprocessing.Process]:
+        """Wait for at most timeout seconds in total for all the workers.
+
+        Return the workers still running.
+        """
         if not self.__workers:
-            return
-        for worker in self.__workers.values():
-            worker.join()
+            return []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        workers = [*self.__workers.values(), *self.__retired_workers.values()]
+        for worker in workers:
+            worker.join(
+                None if deadline is None else max(deadline - time.monotonic(), 0)
+            )
+        return [worker for worker in workers if worker.is_alive()]
 
-    def stop(self, wait_task: bool = True) -> None:
+    def __terminate_workers(
+        self, workers: list[threading.Thread | multiprocessing.Process]
+    ) -> None:
+        # All the workers see the stop event at once and stop after their
+        # current tasks, worker processes are terminated right away.
+        assert self.__stop_event is not None
+        self.__stop_event.set()
+        for worker in workers:
+            if isinstance(worker, threading.Thread):
+                log_error("worker thread %s is still running", worker.name)
+                continue
+            log_error("terminate worker process %s", worker.pid)
+            worker.terminate()
+        for worker in workers:
+            if not isinstance(worker, threading.Thread):
+                worker.join()
+
+    def stop(self, wait_task: bool = True, timeout: float | None = None) -> None:
+        """Stop the workers after they finish the queued tasks.
+
+        With a timeout, the workers still running timeout seconds later are
+        told to stop after their current tasks and worker processes are
+        terminated, dropping the unfinished tasks.
+        """
+        # Pending delayed and periodic tasks are dropped
+        if self.__timer_thread is not None:
+            assert self.__timer_stop_event is not None
+            self.__timer_stop_event.set()
+            with self.__timer_condition:
+                self.__timer_condition.notify()
+            self.__timer_thread.join()
+            self.__timer_thread = None
+        with self.__timer_condition:
+            self.__timer_wheel = TimerWheel()
+        if self.__scaling_thread is not None:
+            assert self.__scaling_stop_event is not None
+            self.__scaling_stop_event.set()
+            self.__scaling_thread.join()
+            self.__scaling_thread = None
+        if self.__monitor_thread is not None:
+            assert self.__monitor_stop_event is not None
+            self.__monitor_stop_event.set()
+            self.__monitor_thread.join()
+            self.__monitor_thread = None
         # stop __workers
         if not self.__workers:
             return
-        for _ in self.__workers:
-            self.add_task(_SentinelTask())
+        for worker_id in self.__workers:
+            self.__put_data(
+                _SentinelTask(), queue_name=self.__get_task_queue_name(worker_id)
+            )
         # block until all tasks are done
         if wait_task:
-            self.join()
+            workers = self.join(timeout=timeout)
+            if workers:
+                self.__terminate_workers(workers)
+            if self.__batch_policy_temp_dir is not None:
+                shutil.rmtree(self.__batch_policy_temp_dir, ignore_errors=True)
+                self.__batch_policy_temp_dir = None
+        self.__stop_dispatching_results()
         self.__workers = {}
-        for q, q_type in self.__queues.values():
+        self.__retired_workers = {}
+        self.__pending_data = {}
+        self.__unacked_tasks = {}
+        self.__leases = {}
+        self.__local_leases = {}
+        self.__heartbeat_times = {}
+        for queue_name, (q, q_type) in self.__queues.items():
+            if queue_name in self.__linked_queue_names:
+                continue
+            if (
+                self.__options.spill_threshold is not None
+                or q_type == QueueType.SharedMemory
+            ) and not self.mp_ctx.in_thread():
+                self.__remove_spilled_data(queue_name)
             if q_type == QueueType.Pipe:
                 q[0].close()
                 q[1].close()
+            elif q_type == QueueType.SharedMemory:
+                q.close()
         self.__queues = {}
+        self.__linked_queue_names = set()
+
+    def __remove_spilled_data(self, queue_name: str) -> None:
+        # The files of data never read would stay in spill_dir.
+        q, queue_type = self.__get_queue(queue_name)
+        while True:
+            try:
+                if queue_type == QueueType.Pipe:
+                    if not q[1].poll():
+                        return
+                    data = self.__receive(q[1])
+                else:
+                    data = q.get(timeout=0.000001)
+            except (queue.Empty, EOFError, BrokenPipeError):
+                return
+            if isinstance(data, _SpilledData):
+                Path(data.path).unlink(missing_ok=True)
 
     def force_stop(self) -> None:
         if self.__stop_event is not None:
             self.__stop_event.set()
+        # Drop the queued tasks so that the sentinels fit into bounded queues.
+        for queue_name in self.__get_all_task_queue_names():
+            self.clear_data(queue_name=queue_name)
         self.stop()
         if self.__stop_event is not None:
             self.__stop_event.clear()
@@ -435,22 +1758,658 @@ class TaskQueue:
     def release(self) -> None:
         self.stop()
 
-    def add_task(self, task: object) -> None:
-        self.put_data(data=task, queue_name="__task")
+    def __get_task_queue_name(self, worker_id: int) -> str:
+        if self.__options.scheduling_mode == SchedulingMode.WorkStealing:
+            return self.get_worker_queue_name(worker_id)
+        return "__task"
+
+    def __get_worker_queue_names(self) -> list[str]:
+        return [
+            self.get_worker_queue_name(worker_id)
+            for worker_id in range(self.max_worker_num)
+            if self.get_worker_queue_name(worker_id) in self.__queues
+        ]
+
+    @classmethod
+    def __get_priority_queue_name(cls, priority: TaskPriority) -> str:
+        return f"__task_{priority.name.lower()}"
+
+    @classmethod
+    def __get_priority_queue_names(cls) -> list[str]:
+        return [
+            cls.__get_priority_queue_name(priority)
+            for priority in TaskPriority
+            if priority != TaskPriority.Normal
+        ]
+
+    def __get_all_task_queue_names(self) -> list[str]:
+        return [
+            queue_name
+            for queue_name in (
+                "__task",
+                *self.__get_priority_queue_names(),
+                *self.__get_worker_queue_names(),
+            )
+            if queue_name in self.__queues
+        ]
+
+    def __next_task_queue_name(
+        self, key: object = None, priority: TaskPriority = TaskPriority.Normal
+    ) -> str:
+        if key is not None:
+            if not self.__worker_queues_in_use:
+                self.__worker_queues_in_use = True
+                assert self.__worker_queues_event is not None
+                self.__worker_queues_event.set()
+            return self.get_worker_queue_name(
+                jump_consistent_hash(key, self.__worker_num)
+            )
+        if priority != TaskPriority.Normal:
+            if not self.__priority_queues_in_use:
+                self.__priority_queues_in_use = True
+                assert self.__priority_queues_event is not None
+                self.__priority_queues_event.set()
+            return self.__get_priority_queue_name(priority)
+        worker_id = self.__next_worker_id % self.__worker_num
+        self.__next_worker_id = worker_id + 1
+        return self.__get_task_queue_name(worker_id)
+
+    def add_task(
+        self,
+        task: object,
+        *,
+        block: bool = True,
+        timeout: float | None = None,
+        delay: float | None = None,
+        options: TaskOptions | None = None,
+    ) -> int | None:
+        """Add a task, routed and expired as options say.
+
+        If the task queues are bounded and full, wait for at most timeout
+        seconds, or don't wait if block is False, before raising queue.Full.
+        With a delay the task is queued after delay seconds, and the id of
+        its timer is returned for cancel_timer().
+        """
+        if delay is None and self.__is_plain(options):
+            self.__put_data(task, queue_name="__task", block=block, timeout=timeout)
+            return None
+        return self.add_tasks(
+            [task], block=block, timeout=timeout, delay=delay, options=options
+        )
+
+    def add_tasks(
+        self,
+        tasks: Iterable[object],
+        *,
+        block: bool = True,
+        timeout: float | None = None,
+        delay: float | None = None,
+        options: TaskOptions | None = None,
+    ) -> int | None:
+        """Add the tasks like add_task, the timeout bounds the whole call.
+
+        If queue.Full is raised, the tasks before the first one not fitting
+        stay queued.
+        """
+        if delay is None and self.__is_plain(options):
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for task in tasks:
+                self.__put_data(
+                    task,
+                    queue_name="__task",
+                    block=block,
+                    timeout=None
+                    if deadline is None
+                    else max(deadline - time.monotonic(), 0),
+                )
+            return None
+        if options is None:
+            options = TaskOptions()
+        self.__check_task_options(options)
+        if delay is not None:
+            return self.__add_timer(
+                functools.partial(self.__put_tasks, list(tasks), options),
+                delay=delay,
+            )
+        self.__put_tasks(list(tasks), options, block=block, timeout=timeout)
+        return None
+
+    def add_periodic_task(
+        self,
+        task: object,
+        interval: float,
+        *,
+        delay: float | None = None,
+        options: TaskOptions | None = None,
+    ) -> int:
+        """Add the task every interval seconds, first after delay seconds.
+
+        The deadline of options is ignored. Return the id of its timer for
+        cancel_timer().
+        """
+        options = copy.replace(options or TaskOptions(), deadline=None)
+        self.__check_task_options(options)
+        return self.__add_timer(
+            functools.partial(self.__put_tasks, [task], options),
+            delay=interval if delay is None else delay,
+            interval=interval,
+        )
+
+    def __is_plain(self, options: TaskOptions | None) -> bool:
+        return self.__puts_plain_tasks_directly and (
+            options is None
+            or (
+                options.key is None
+                and options.priority == TaskPriority.Normal
+                and options.deadline is None
+            )
+        )
+
+    def __check_task_options(self, options: TaskOptions) -> None:
+        if options.key is not None and not self.__has_worker_queues:
+            raise ValueError("keyed tasks need use_task_keys in TaskQueueOptions")
+        if (
+            options.key is None
+            and options.priority != TaskPriority.Normal
+            and not self.__options.use_task_priorities
+        ):
+            raise ValueError(
+                "prioritized tasks need use_task_priorities in TaskQueueOptions"
+            )
+
+    def cancel_timer(self, timer_id: int) -> bool:
+        """Cancel a delayed or periodic task not yet due, return if it existed."""
+        with self.__timer_condition:
+            return self.__timer_wheel.cancel(timer_id)
+
+    def __add_timer(
+        self, put_tasks: Callable, delay: float, interval: float | None = None
+    ) -> int:
+        assert self.__workers, "call start() before adding delayed tasks"
+        with self.__timer_condition:
+            timer_id = self.__timer_wheel.add(
+                delay=delay, item=put_tasks, interval=interval
+            )
+            self.__timer_condition.notify()
+            if self.__timer_thread is None:
+                self.__timer_stop_event = threading.Event()
+                self.__timer_thread = threading.Thread(
+                    name="timer", target=self.__put_due_tasks, daemon=True
+                )
+                self.__timer_thread.start()
+        return timer_id
+
+    def __put_due_tasks(self) -> None:
+        # A single thread serves all the timers and puts the tasks due.
+        stop_event = self.__timer_stop_event
+        assert stop_event is not None
+        while not stop_event.is_set():
+            with self.__timer_condition:
+                # Adding a timer notifies, as it may be due earlier.
+                next_due_time = self.__timer_wheel.next_due_time()
+                if next_due_time is None:
+                    self.__timer_condition.wait()
+                else:
+                    self.__timer_condition.wait(
+                        timeout=max(next_due_time - time.monotonic(), 0)
+                    )
+                due_tasks = self.__timer_wheel.advance()
+            for put_tasks in due_tasks:
+                if stop_event.is_set():
+                    return
+                try:
+                    put_tasks(block=False, timeout=None)
+                except queue.Full:
+                    # Retry on the next tick instead of blocking other timers
+                    with self.__timer_condition:
+                        self.__timer_wheel.add(
+                            delay=self.__timer_wheel.tick, item=put_tasks
+                        )
+
+    def __put_tasks(
+        self,
+        tasks: list,
+        options: TaskOptions,
+        block: bool,
+        timeout: float | None,
+    ) -> None:
+        if options.deadline is not None:
+            tasks = [_DeadlineTask(task, options.deadline) for task in tasks]
+        if self.__options.task_retry_limit is not None:
+            tasks = [_TrackedTask(next(self.__task_ids), task) for task in tasks]
+        # The tasks already put stay queued if queue.Full is raised.
+        self.__put_many_with_backpressure(
+            collections.deque(tasks),
+            key=options.key,
+            block=block,
+            timeout=timeout,
+            priority=options.priority,
+        )
+
+    def __put_many_with_backpressure(
+        self,
+        remaining_tasks: collections.deque,
+        key: object,
+        block: bool,
+        timeout: float | None,
+        priority: TaskPriority,
+    ) -> None:
+        # Every task is a message of its own, so bounded queues count tasks.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait_time = 0.001
+        while True:
+            # Don't hold the lock while waiting, so workers can still be
+            # added to drain the queues.
+            with self.__worker_lock:
+                try:
+                    # Each task takes the next queue, so that the tasks are
+                    # spread over the workers.
+                    while remaining_tasks:
+                        task = remaining_tasks[0]
+                        # Tracked under the lock, so that a task being put is
+                        # never taken as lost by the worker monitor.
+                        if isinstance(task, _TrackedTask):
+                            self.__unacked_tasks[task.task_id] = (task, key, priority)
+                        try:
+                            self.put_data(
+                                task,
+                                queue_name=self.__next_task_queue_name(
+                                    key=key, priority=priority
+                                ),
+                                block=False,
+                            )
+                        except queue.Full:
+                            if isinstance(task, _TrackedTask):
+                                self.__unacked_tasks.pop(task.task_id)
+                            raise
+                        remaining_tasks.popleft()
+                    return
+                except queue.Full:
+                    if not block:
+                        raise
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.monotonic())
+                if wait_time <= 0:
+                    raise queue.Full
+            time.sleep(wait_time)
+            wait_time = min(wait_time * 2, 0.01)
+
+    def get_task(self, timeout: float | None, worker_id: int | None = None) -> Expected:
+        if worker_id is None:
+            return self.get_data(queue_name="__task", timeout=timeout)
+        if self.__takes_plain_tasks_only:
+            # The sentinels are expected in __task, no need to check them.
+            task = self.__get_data(queue_name="__task", timeout=timeout)
+            if not task.is_ok() or not isinstance(task.value(), _DeadlineTask):
+                return task
+            tasks = self.__remove_expired_tasks([task.value()])
+            if tasks:
+                return Expected.ok(value=tasks[0])
+        tasks = self.get_tasks(max_tasks=1, timeout=timeout, worker_id=worker_id)
+        if not tasks:
+            return Expected.not_ok()
+        return Expected.ok(value=tasks[0])
+
+    def get_tasks(
+        self, max_tasks: int, timeout: float | None, worker_id: int | None = None
+    ) -> list:
+        if worker_id is None:
+            return self.get_many(
+                max_items=max_tasks, timeout=timeout, queue_name="__task"
+            )
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.__takes_plain_tasks_only:
+            tasks = self.__remove_expired_tasks(
+                self.get_many(
+                    max_items=max_tasks,
+                    timeout=None
+                    if deadline is None
+                    else max(deadline - time.monotonic(), 0),
+                    queue_name="__task",
+                )
+            )
+            if tasks or (deadline is not None and time.monotonic() >= deadline):
+                return tasks
+        while True:
+            # Block for a while at most, to see if more queues come into use.
+            wait_time = self.__queue_usage_check_interval
+            if deadline is not None:
+                wait_time = max(min(wait_time, deadline - time.monotonic()), 0)
+            queue_names = self.__get_worker_task_queue_names(worker_id)
+            if len(queue_names) == 1:
+                tasks = self.get_many(
+                    max_items=max_tasks, timeout=wait_time, queue_name=queue_names[0]
+                )
+                if (
+                    tasks
+                    and isinstance(tasks[-1], _SentinelTask)
+                    and len(self.__get_worker_task_queue_names(worker_id, True)) > 1
+                ):
+                    # Finish the tasks in the queues just in use before stopping
+                    self.__put_data(tasks.pop(), queue_name=queue_names[0])
+            else:
+                tasks = self.__take_tasks(queue_names, worker_id, max_tasks)
+                if not tasks and wait_time > 0:
+                    self.wait_any(queue_names, timeout=wait_time)
+                    continue
+            tasks = self.__lease_tasks(tasks, worker_id=worker_id)
+            tasks = self.__remove_expired_tasks(tasks)
+            if tasks or (deadline is not None and time.monotonic() >= deadline):
+                return tasks
+
+    def __get_worker_task_queue_names(
+        self, worker_id: int, refresh: bool = False
+    ) -> list[str]:
+        """Return the queues the worker takes tasks from, in order."""
+        if refresh or time.monotonic() >= self.__next_queue_usage_check_time:
+            self.__next_queue_usage_check_time = (
+                time.monotonic() + self.__queue_usage_check_interval
+            )
+            if (
+                not self.__worker_queues_in_use
+                and self.__worker_queues_event is not None
+            ):
+                self.__worker_queues_in_use = self.__worker_queues_event.is_set()
+            if (
+                not self.__priority_queues_in_use
+                and self.__priority_queues_event is not None
+            ):
+                self.__priority_queues_in_use = self.__priority_queues_event.is_set()
+        own_queue_name = self.get_worker_queue_name(worker_id)
+        if self.__options.scheduling_mode == SchedulingMode.WorkStealing:
+            other_queue_names = [
+                name
+                for name in self.__get_worker_queue_names()
+                if name != own_queue_name
+            ]
+            random.shuffle(other_queue_names)
+            queue_names = [own_queue_name, *other_queue_names]
+        elif self.__worker_queues_in_use:
+            queue_names = [own_queue_name, "__task"]
+        else:
+            queue_names = ["__task"]
+        if self.__priority_queues_in_use:
+            queue_names = [
+                self.__get_priority_queue_name(TaskPriority.High),
+                *queue_names,
+                self.__get_priority_queue_name(TaskPriority.Low),
+            ]
+        return queue_names
+
+    def __take_tasks(
+        self, queue_names: list[str], worker_id: int, max_tasks: int
+    ) -> list:
+        own_queue_name = self.get_worker_queue_name(worker_id)
+        for queue_name in queue_names:
+            tasks = self.get_many(max_items=max_tasks, timeout=0, queue_name=queue_name)
+            if (
+                tasks
+                and isinstance(tasks[-1], _SentinelTask)
+                and (
+                    (
+                        queue_name != own_queue_name
+                        and self.__options.scheduling_mode
+                        == SchedulingMode.WorkStealing
+                    )
+                    or any(
+                        self.has_data(queue_name=name)
+                        for name in (own_queue_name, *self.__get_priority_queue_names())
+                        if name != queue_name and name in queue_names
+                    )
+                )
+            ):
+                # A sentinel in a peer queue only stops its owner, and the
+                # keyed tasks in the own queue and the prioritized tasks are
+                # finished before stopping, so give it back.
+                self.__put_data(tasks.pop(), queue_name=queue_name)
+            if tasks:
+                return tasks
+        return []
+
+    def __remove_expired_tasks(self, tasks: list) -> list:
+        if not any(isinstance(task, _DeadlineTask) for task in tasks):
+            return tasks
+        unexpired_tasks: list = []
+        for task in tasks:
+            if not isinstance(task, _DeadlineTask):
+                unexpired_tasks.append(task)
+            elif time.time() <= task.deadline:
+                unexpired_tasks.append(task.task)
+            elif isinstance(task.task, _TaggedTask):
+                self.put_data(
+                    _TaggedResult(
+                        task.task.sequence_id,
+                        exception=TimeoutError("the task missed its deadline"),
+                    ),
+                    queue_name="__future_result",
+                )
+            elif self.__options.flag_expired_tasks:
+                self.put_data(ExpiredTask(task.task), queue_name="__result")
+            else:
+                log_debug("drop the task missing its deadline")
+        return unexpired_tasks
+
+    def wait_any(
+        self, queue_names: Iterable[str], timeout: float | None = None
+    ) -> list[str]:
+        """Block until some of the queues have data and return their names.
+
+        The list is empty if timeout expires, or if another consumer took the
+        data first.
+        """
+        queue_names = list(queue_names)
+        queues = [self.__get_queue(queue_name)[0] for queue_name in queue_names]
+        if all(isinstance(q, ThreadQueue) for q in queues):
+            return self.__wait_thread_queues(queue_names, queues, timeout=timeout)
+        ready_queue_names = [
+            queue_name for queue_name in queue_names if self.has_data(queue_name)
+        ]
+        if ready_queue_names:
+            return ready_queue_names
+        readers: list = []
+        for queue_name in queue_names:
+            q, queue_type = self.__get_queue(queue_name)
+            if queue_type == QueueType.Pipe:
+                readers.append(q[1])
+            elif isinstance(q, multiprocessing.queues.Queue):
+                # pylint: disable=protected-access
+                readers.append(q._reader)  # type: ignore[attr-defined]
+            else:
+                break
+        else:
+            multiprocessing.connection.wait(readers, timeout=timeout)
+            return [
+                queue_name for queue_name in queue_names if self.has_data(queue_name)
+            ]
+        # Fall back to polling for queues without a waitable reader.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait_time = 0.001
+        while not ready_queue_names:
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.monotonic())
+                if wait_time <= 0:
+                    break
+            time.sleep(wait_time)
+            wait_time = min(wait_time * 2, 0.01)
+            ready_queue_names = [
+                queue_name for queue_name in queue_names if self.has_data(queue_name)
+            ]
+        return ready_queue_names
+
+    def __wait_thread_queues(
+        self, queue_names: list[str], queues: list[ThreadQueue], timeout: float | None
+    ) -> list[str]:
+        # The event is added before looking at the queues, so no put is missed.
+        event = threading.Event()
+        for q in queues:
+            q.add_event(event)
+        try:
+            ready_queue_names = [
+                queue_name for queue_name in queue_names if self.has_data(queue_name)
+            ]
+            if not ready_queue_names and event.wait(timeout):
+                ready_queue_names = [
+                    queue_name
+                    for queue_name in queue_names
+                    if self.has_data(queue_name)
+                ]
+            return ready_queue_names
+        finally:
+            for q in queues:
+                q.remove_event(event)
+
+    def submit(
+        self,
+        task: object,
+        *,
+        block: bool = True,
+        timeout: float | None = None,
+        options: TaskOptions | None = None,
+    ) -> concurrent.futures.Future:
+        """Add a task and return a Future of its result.
+
+        The result goes to the Future instead of the __result queue, and an
+        exception raised by worker_fun is set on the Future.
+        With deduplicate_tasks, a task equal by its pickled bytes and options
+        to one still queued or running shares that task's Future.
+        """
+        assert self.__workers, "call start() before submit()"
+        if not self.__uses_futures:
+            raise ValueError("submit() needs use_futures in TaskQueueOptions")
+        if options is None:
+            options = TaskOptions()
+        self.__check_task_options(options)
+        if not self.__options.deduplicate_tasks:
+            return self.__submit(task, options, block, timeout)
+        task_fingerprint = fingerprint((task, options))
+        if task_fingerprint is None:
+            return self.__submit(task, options, block, timeout)
+        with self.__inflight_lock:
+            future = self.__inflight_futures.get(task_fingerprint)
+            if future is not None:
+                return future
+            future = self.__submit(task, options, block, timeout)
+            self.__inflight_futures[task_fingerprint] = future
+        future.add_done_callback(
+            functools.partial(self.__remove_inflight_future, task_fingerprint)
+        )
+        return future
+
+    def __remove_inflight_future(
+        self, task_fingerprint: bytes, future: concurrent.futures.Future
+    ) -> None:
+        with self.__inflight_lock:
+            if self.__inflight_futures.get(task_fingerprint) is future:
+                self.__inflight_futures.pop(task_fingerprint)
 
-    def get_task(self, timeout: float | None) -> Expected:
-        return self.get_data(queue_name="__task", timeout=timeout)
+    def __submit(
+        self,
+        task: object,
+        options: TaskOptions,
+        block: bool,
+        timeout: float | None,
+    ) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        sequence_id = next(self.__sequence_ids)
+        self.__futures[sequence_id] = future
+        if self.__dispatch_thread is None:
+            self.__dispatch_stop_event = threading.Event()
+            self.__dispatch_thread = threading.Thread(
+                name="result dispatching", target=self.__dispatch_results, daemon=True
+            )
+            self.__dispatch_thread.start()
+        try:
+            self.add_task(
+                _TaggedTask(sequence_id, task),
+                block=block,
+                timeout=timeout,
+                options=options,
+            )
+        except queue.Full:
+            self.__futures.pop(sequence_id)
+            raise
+        return future
+
+    def imap(
+        self,
+        tasks: Iterable[object],
+        ordered: bool = True,
+        max_in_flight: int | None = None,
+    ) -> Generator[object]:
+        """Submit tasks and yield their results as they become available.
+
+        At most max_in_flight tasks are submitted but not yet yielded, so both
+        the queued tasks and the buffered results stay bounded.
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * self.__worker_num
+        assert max_in_flight >= 1, max_in_flight
+        futures: collections.deque[concurrent.futures.Future] = collections.deque()
+        for task in tasks:
+            if len(futures) >= max_in_flight:
+                yield from self.__pop_done_futures(futures, ordered=ordered)
+            futures.append(self.submit(task))
+        while futures:
+            yield from self.__pop_done_futures(futures, ordered=ordered)
+
+    @classmethod
+    def __pop_done_futures(
+        cls, futures: collections.deque, ordered: bool
+    ) -> Generator[object]:
+        if ordered:
+            yield futures.popleft().result()
+            return
+        done_futures, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done_futures:
+            futures.remove(future)
+        for future in done_futures:
+            yield future.result()
+
+    def __dispatch_results(self) -> None:
+        stop_event = self.__dispatch_stop_event
+        assert stop_event is not None
+        while True:
+            tagged_results = self.get_many(
+                max_items=1024, timeout=0.1, queue_name="__future_result"
+            )
+            if not tagged_results and stop_event.is_set():
+                return
+            for tagged_result in tagged_results:
+                # A redelivered task may return its result again
+                future = self.__futures.pop(tagged_result.sequence_id, None)
+                # Once running, the future can't be cancelled by its caller
+                # before getting the result.
+                if future is None or not future.set_running_or_notify_cancel():
+                    continue
+                if tagged_result.exception is not None:
+                    future.set_exception(tagged_result.exception)
+                else:
+                    future.set_result(tagged_result.result)
+
+    def __stop_dispatching_results(self) -> None:
+        if self.__dispatch_thread is not None:
+            assert self.__dispatch_stop_event is not None
+            self.__dispatch_stop_event.set()
+            self.__dispatch_thread.join()
+            self.__dispatch_thread = None
+        # Tasks that will never run
+        for future in self.__futures.values():
+            future.cancel()
+        self.__futures = {}
 
     def has_task(self) -> bool:
-        return self.has_data(queue_name="__task")
+        return any(
+            self.has_data(queue_name=queue_name)
+            for queue_name in self.__get_all_task_queue_names()
+        )
 
     def clear_data(self, queue_name: str) -> None:
         if queue_name not in self.__queues:
             return
-        while True:
-            res = self.get_data(queue_name=queue_name, timeout=0.000001)
-            if not res.is_ok():
-                return
+        while self.get_many(max_items=1024, timeout=0.000001, queue_name=queue_name):
+            pass
 
     def get_data(
         self, queue_name: str = "__result", timeout: float | None = None
@@ -460,24 +2419,78 @@ class TaskQueue:
             res.is_ok()
             and isinstance(res.value(), _SentinelTask)
             and queue_name != "__task"
+            and queue_name not in self.__get_worker_queue_names()
         ):
             raise RuntimeError("Sending _SentinelTask in queue:" + queue_name)
         return res
 
+    def get_many(
+        self,
+        max_items: int,
+        timeout: float | None = None,
+        queue_name: str = "__result",
+    ) -> list:
+        """Get up to max_items, blocking at most timeout for the first one.
+
+        The rest are only taken if they are already available, and a
+        _SentinelTask always ends the list so that each worker consumes exactly
+        one of them.
+        """
+        assert max_items >= 1, max_items
+        data_list: list = []
+        while len(data_list) < max_items:
+            res = self.get_data(
+                queue_name=queue_name, timeout=timeout if not data_list else 0
+            )
+            if not res.is_ok():
+                break
+            data_list.append(res.value())
+            if isinstance(data_list[-1], _SentinelTask):
+                break
+        return data_list
+
     def __get_data(self, /, queue_name: str, timeout: float | None) -> Expected[object]:
+        pending_data = self.__pending_data.get(queue_name)
+        if pending_data:
+            try:
+                return Expected.ok(value=self.__pop_pending_data(pending_data))
+            except IndexError:
+                pass
         result_queue, queue_type = self.__get_queue(queue_name)
         try:
             if queue_type == QueueType.Pipe:
-                if result_queue[1].poll(timeout):
-                    res = result_queue[1].recv()
-                    return Expected.ok(value=res)
-                return Expected.not_ok()
-            res = result_queue.get(timeout=timeout)
-            return Expected.ok(value=res)
+                if not result_queue[1].poll(timeout):
+                    return Expected.not_ok()
+                res = self.__receive(result_queue[1])
+            else:
+                res = result_queue.get(timeout=timeout)
         except (queue.Empty, EOFError, BrokenPipeError):
             return Expected.not_ok()
+        if isinstance(res, (_SpilledData, _SerializedData)):
+            res = self.__decode_data(res)
+        if isinstance(res, (_DataBatch, RepeatedResult)):
+            pending_data = self.__pending_data.setdefault(
+                queue_name, collections.deque()
+            )
+            if isinstance(res, _DataBatch):
+                pending_data.extend(res.data_list)
+            else:
+                pending_data.append(res)
+            return Expected.ok(value=self.__pop_pending_data(pending_data))
+        return Expected.ok(value=res)
+
+    def __pop_pending_data(self, pending_data: collections.deque) -> object:
+        with self.__pending_lock:
+            data = pending_data[0]
+            if not isinstance(data, RepeatedResult):
+                return pending_data.popleft()
+            if len(data) == 1:
+                pending_data.popleft()
+            return data.pop_data()
 
     def has_data(self, queue_name: str = "__result") -> bool:
+        if self.__pending_data.get(queue_name):
+            return True
         queue, queue_type = self.__get_queue(queue_name)
         if queue_type == QueueType.Pipe:
             return queue[1].poll()
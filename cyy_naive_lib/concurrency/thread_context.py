@@ -5,9 +5,34 @@ from collections.abc import Callable
 from .context import ConcurrencyContext
 
 
+class ThreadQueue(queue.Queue):
+    """A queue.Queue setting the events added to it on every put.
+
+    Waiting on an event added to several queues blocks until any of them
+    gets data.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        super().__init__(maxsize=maxsize)
+        self.__events: set[threading.Event] = set()
+
+    def add_event(self, event: threading.Event) -> None:
+        with self.mutex:
+            self.__events.add(event)
+
+    def remove_event(self, event: threading.Event) -> None:
+        with self.mutex:
+            self.__events.discard(event)
+
+    def _put(self, item: object) -> None:
+        super()._put(item)
+        for event in self.__events:
+            event.set()
+
+
 class ThreadContext(ConcurrencyContext):
-    def create_queue(self) -> queue.Queue:
-        return queue.Queue()
+    def create_queue(self, maxsize: int = 0) -> queue.Queue:
+        return ThreadQueue(maxsize=maxsize)
 
     def in_thread(self) -> bool:
         return True
@@ -4,5 +4,8 @@ from .executor import ExecutorWrapper
 
 
 class ThreadPool(ExecutorWrapper):
-    def __init__(self) -> None:
-        super().__init__(executor=concurrent.futures.ThreadPoolExecutor())
+    def __init__(self, deduplicate_tasks: bool = False) -> None:
+        super().__init__(
+            executor=concurrent.futures.ThreadPoolExecutor(),
+            deduplicate_tasks=deduplicate_tasks,
+        )
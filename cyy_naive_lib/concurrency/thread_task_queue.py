@@ -7,9 +7,11 @@ class ThreadTaskQueue(TaskQueue):
         self,
         worker_num: int = 1,
         batch_policy_type: type[BatchPolicy] | None = None,
+        **kwargs,
     ) -> None:
         super().__init__(
             mp_ctx=ThreadContext(),
             worker_num=worker_num,
             batch_policy_type=batch_policy_type,
+            **kwargs,
         )
@@ -0,0 +1,165 @@
+import itertools
+import math
+import time
+
+
+class _Timer:
+    def __init__(
+        self, timer_id: int, expire_tick: int, item: object, interval: int | None
+    ) -> None:
+        self.timer_id = timer_id
+        self.expire_tick = expire_tick
+        self.item = item
+        # Periodic timers are added again interval ticks after expiring
+        self.interval = interval
+
+
+class TimerWheel:
+    """A hierarchical timing wheel holding items until their delay passes.
+
+    Level l has slot_num slots of slot_num**l ticks each, so adding and
+    cancelling a timer is O(1) and advancing costs O(1) per tick plus the
+    expired timers, however many timers are pending. A timer expires at most
+    one tick late, delays beyond the top level are reached in several rounds.
+    """
+
+    def __init__(
+        self, tick: float = 0.01, slot_num: int = 256, level_num: int = 4
+    ) -> None:
+        assert tick > 0 and slot_num > 1 and level_num > 0
+        self.__tick: float = tick
+        self.__slot_num: int = slot_num
+        self.__wheels: list[list[list[_Timer]]] = [
+            [[] for _ in range(slot_num)] for _ in range(level_num)
+        ]
+        self.__start_time: float = time.monotonic()
+        self.__current_tick: int = 0
+        self.__timers: dict[int, _Timer] = {}
+        self.__timer_ids = itertools.count()
+
+    @property
+    def tick(self) -> float:
+        return self.__tick
+
+    def __len__(self) -> int:
+        return len(self.__timers)
+
+    def add(self, delay: float, item: object, interval: float | None = None) -> int:
+        """Add item expiring after delay seconds and return the timer id.
+
+        If interval is given, the item expires again every interval seconds
+        until the timer is cancelled.
+        """
+        now = time.monotonic()
+        if not self.__timers:
+            self.__current_tick = max(self.__current_tick, self.__get_tick(now))
+        timer = _Timer(
+            timer_id=next(self.__timer_ids),
+            # Never expire early, and the current tick has been processed.
+            expire_tick=max(
+                math.ceil((now + delay - self.__start_time) / self.__tick),
+                self.__current_tick + 1,
+            ),
+            item=item,
+            interval=None
+            if interval is None
+            else max(math.ceil(interval / self.__tick), 1),
+        )
+        self.__timers[timer.timer_id] = timer
+        self.__place(timer)
+        return timer.timer_id
+
+    def cancel(self, timer_id: int) -> bool:
+        # The timer stays in its slot and is skipped when reached.
+        return self.__timers.pop(timer_id, None) is not None
+
+    def advance(self, now: float | None = None) -> list[object]:
+        """Move the wheel to now and return the expired items in order."""
+        target_tick = self.__get_tick(time.monotonic() if now is None else now)
+        if not self.__timers:
+            self.__current_tick = max(self.__current_tick, target_tick)
+            return []
+        items: list[object] = []
+        while self.__current_tick < target_tick:
+            self.__current_tick += 1
+            self.__cascade()
+            slot = self.__wheels[0][self.__current_tick % self.__slot_num]
+            timers = slot.copy()
+            slot.clear()
+            for timer in timers:
+                if self.__timers.get(timer.timer_id) is not timer:
+                    continue
+                if timer.expire_tick > self.__current_tick:
+                    self.__place(timer)
+                    continue
+                items.append(timer.item)
+                if timer.interval is None:
+                    self.__timers.pop(timer.timer_id)
+                else:
+                    timer.expire_tick += timer.interval
+                    self.__place(timer)
+        return items
+
+    def next_due_time(self) -> float | None:
+        """Return the time.monotonic() time advance() has to be called next.
+
+        The time is exact for timers due within slot_num ticks, farther timers
+        give the time their slot of an upper level moves down, which is never
+        later. Return None without timers.
+        """
+        if not self.__timers:
+            return None
+        due_tick: int | None = None
+        span = 1
+        for wheel in self.__wheels:
+            # Level 0 expires its slots, upper levels move them down.
+            for offset in range(1, self.__slot_num + 1):
+                tick = (self.__current_tick // span + offset) * span
+                if due_tick is not None and tick >= due_tick:
+                    break
+                if any(
+                    self.__timers.get(timer.timer_id) is timer
+                    for timer in wheel[(tick // span) % self.__slot_num]
+                ):
+                    due_tick = tick
+                    break
+            span *= self.__slot_num
+        if due_tick is None:
+            due_tick = self.__current_tick + 1
+        # Slightly into the tick, so that rounding doesn't give the tick before
+        return self.__start_time + (due_tick + 0.001) * self.__tick
+
+    def __get_tick(self, now: float) -> int:
+        return math.floor((now - self.__start_time) / self.__tick)
+
+    def __cascade(self) -> None:
+        # At the start of a slot of an upper level, its timers move down.
+        span = 1
+        spans = []
+        for _ in range(1, len(self.__wheels)):
+            span *= self.__slot_num
+            if self.__current_tick % span:
+                break
+            spans.append(span)
+        for level in range(len(spans), 0, -1):
+            slot = self.__wheels[level][
+                (self.__current_tick // spans[level - 1]) % self.__slot_num
+            ]
+            timers = slot.copy()
+            slot.clear()
+            for timer in timers:
+                if self.__timers.get(timer.timer_id) is timer:
+                    self.__place(timer)
+
+    def __place(self, timer: _Timer) -> None:
+        delta = max(timer.expire_tick - self.__current_tick, 0)
+        span = 1
+        for level, wheel in enumerate(self.__wheels):
+            if delta < span * self.__slot_num or level + 1 == len(self.__wheels):
+                expire_tick = min(
+                    timer.expire_tick,
+                    self.__current_tick + span * self.__slot_num - 1,
+                )
+                wheel[(expire_tick // span) % self.__slot_num].append(timer)
+                return
+            span *= self.__slot_num
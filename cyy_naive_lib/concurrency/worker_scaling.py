@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+
+import psutil
+
+
+@dataclass(kw_only=True)
+class WorkerScalingPolicy:
+    """Decide how many workers a TaskQueue should run.
+
+    The queue grows by one worker while the task backlog is larger than
+    backlog_per_worker tasks per worker and the host CPU has headroom, and it
+    retires one worker after the backlog has stayed empty for idle_seconds or
+    when the host runs low on memory.
+    """
+
+    min_worker_num: int
+    max_worker_num: int
+    interval: float = 1
+    backlog_per_worker: int = 2
+    idle_seconds: float = 10
+    max_cpu_percent: float = 90
+    min_available_memory_percent: float = 10
+
+    def __post_init__(self) -> None:
+        assert 1 <= self.min_worker_num <= self.max_worker_num
+
+    def clamp(self, worker_num: int) -> int:
+        return min(max(worker_num, self.min_worker_num), self.max_worker_num)
+
+    def get_worker_num(
+        self, worker_num: int, task_backlog: int, idle_seconds: float
+    ) -> int:
+        memory = psutil.virtual_memory()
+        if memory.available * 100 / memory.total < self.min_available_memory_percent:
+            return self.clamp(worker_num - 1)
+        if (
+            task_backlog > worker_num * self.backlog_per_worker
+            and psutil.cpu_percent() < self.max_cpu_percent
+        ):
+            return self.clamp(worker_num + 1)
+        if idle_seconds >= self.idle_seconds:
+            return self.clamp(worker_num - 1)
+        return self.clamp(worker_num)
@@ -3,14 +3,24 @@ from .json import (
     load_json,
     save_json,
 )
+from .serializer import (
+    Compression,
+    Serializer,
+    get_default_serializer,
+    set_default_serializer,
+)
 from .storage import SyncedDataStorage as DataStorage
 from .storage import get_cached_data, persistent_cache
 
 __all__ = [
+    "Compression",
     "DataStorage",
     "GlobalStore",
+    "Serializer",
     "get_cached_data",
+    "get_default_serializer",
     "load_json",
     "persistent_cache",
     "save_json",
+    "set_default_serializer",
 ]
@@ -0,0 +1,202 @@
+import bz2
+import io
+import lzma
+import pickle
+import struct
+import zlib
+from collections.abc import Callable, Sequence
+from enum import IntEnum, auto
+from typing import BinaryIO
+
+import dill
+
+
+class Compression(IntEnum):
+    NoCompression = 0
+    Zlib = auto()
+    LZMA = auto()
+    BZ2 = auto()
+
+
+class _PicklerType(IntEnum):
+    Pickle = 0
+    Dill = auto()
+
+
+_compressors: dict[Compression, tuple[Callable, Callable]] = {
+    Compression.Zlib: (zlib.compress, zlib.decompress),
+    Compression.LZMA: (lzma.compress, lzma.decompress),
+    Compression.BZ2: (bz2.compress, bz2.decompress),
+}
+
+
+def _load_memoryview(buffer: object, fmt: str, shape: tuple[int, ...]) -> memoryview:
+    return memoryview(buffer).cast("B").cast(fmt, shape)  # type: ignore[arg-type]
+
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj: object) -> object:
+        # memoryview can't be pickled, its memory goes out-of-band instead.
+        if isinstance(obj, memoryview):
+            view = obj if obj.c_contiguous else memoryview(obj.tobytes())
+            return _load_memoryview, (pickle.PickleBuffer(view), obj.format, obj.shape)
+        return NotImplemented
+
+
+class Serializer:
+    """Serialize objects with pickle protocol 5, and dill for what pickle can't.
+
+    Buffers supporting out-of-band pickling, such as bytearray, memoryview and
+    contiguous NumPy arrays wrapped by pickle.PickleBuffer, are kept out of the
+    pickle stream and written as separate frames without copying. Frames larger
+    than compression_threshold bytes are compressed if compression is set.
+    """
+
+    __magic = b"CYYS"
+    # pickler type, compression, number of frames
+    __header = struct.Struct("<BBI")
+    __length = struct.Struct("<Q")
+    __compressed_flag = 1 << 63
+
+    def __init__(
+        self,
+        compression: Compression = Compression.NoCompression,
+        compression_threshold: int = 4096,
+        use_dill: bool = True,
+    ) -> None:
+        self.compression: Compression = compression
+        self.compression_threshold: int = compression_threshold
+        self.use_dill: bool = use_dill
+
+    def dumps_frames(self, obj: object) -> list[bytes | memoryview]:
+        """Serialize obj into frames, the first is a header with their lengths."""
+        buffers: list[pickle.PickleBuffer] = []
+        pickler_type = _PicklerType.Pickle
+        try:
+            file = io.BytesIO()
+            _Pickler(file, protocol=5, buffer_callback=buffers.append).dump(obj)
+            payload = file.getvalue()
+        except (pickle.PicklingError, AttributeError, TypeError):
+            if not self.use_dill:
+                raise
+            buffers = []
+            pickler_type = _PicklerType.Dill
+            payload = dill.dumps(obj, protocol=5)
+        frames: list[bytes | memoryview] = [
+            payload,
+            *(buffer.raw() for buffer in buffers),
+        ]
+        lengths = []
+        for idx, frame in enumerate(frames):
+            length = memoryview(frame).nbytes
+            if (
+                self.compression != Compression.NoCompression
+                and length > self.compression_threshold
+            ):
+                frames[idx] = _compressors[self.compression][0](frame)
+                # The highest bit marks a compressed frame
+                length = len(frames[idx]) | self.__compressed_flag
+            lengths.append(length)
+        header = self.__magic + self.__header.pack(
+            pickler_type, self.compression, len(frames)
+        )
+        header += b"".join(self.__length.pack(length) for length in lengths)
+        return [header, *frames]
+
+    def dumps(self, obj: object) -> bytearray:
+        """Serialize obj into one buffer.
+
+        The buffer is writable, so arrays loaded from it by loads() share its
+        memory and are writable.
+        """
+        return bytearray().join(self.dumps_frames(obj))
+
+    def dump(self, obj: object, file: BinaryIO) -> None:
+        for frame in self.dumps_frames(obj):
+            file.write(frame)
+
+    def loads(self, data: bytes | bytearray | memoryview) -> object:
+        # Arrays loaded share the memory of data and are read-only if data is.
+        view = memoryview(data)
+        pickler_type, compression, lengths, offset = self.__parse_header(view)
+        frames: list[memoryview] = []
+        for length in lengths:
+            frames.append(view[offset : offset + (length & ~self.__compressed_flag)])
+            offset += length & ~self.__compressed_flag
+        return self.__load_frames(pickler_type, compression, lengths, frames)
+
+    def loads_frames(self, frames: Sequence[bytes | bytearray | memoryview]) -> object:
+        """Load the frames of dumps_frames without joining them."""
+        pickler_type, compression, lengths, _ = self.__parse_header(
+            memoryview(frames[0])
+        )
+        return self.__load_frames(pickler_type, compression, lengths, list(frames[1:]))
+
+    def get_frame_sizes(self, header: bytes | bytearray | memoryview) -> list[int]:
+        """Return the sizes of the frames following the header of dumps_frames."""
+        _, _, lengths, _ = self.__parse_header(memoryview(header))
+        return [length & ~self.__compressed_flag for length in lengths]
+
+    def load(self, file: BinaryIO) -> object:
+        prefix = file.read(len(self.__magic) + self.__header.size)
+        pickler_type, compression, frame_num = self.__unpack_header(prefix)
+        lengths = [
+            self.__length.unpack(file.read(self.__length.size))[0]
+            for _ in range(frame_num)
+        ]
+        frames: list[bytearray] = []
+        for length in lengths:
+            frame = bytearray(length & ~self.__compressed_flag)
+            file.readinto(frame)  # type: ignore[attr-defined]
+            frames.append(frame)
+        return self.__load_frames(pickler_type, compression, lengths, frames)
+
+    @classmethod
+    def is_serialized(cls, data: bytes | bytearray | memoryview) -> bool:
+        return bytes(data[: len(cls.__magic)]) == cls.__magic
+
+    def __unpack_header(self, prefix: bytes | memoryview) -> tuple[int, int, int]:
+        if not self.is_serialized(prefix):
+            raise ValueError("data is not serialized by Serializer")
+        return self.__header.unpack_from(prefix, len(self.__magic))
+
+    def __parse_header(self, view: memoryview) -> tuple[int, int, list[int], int]:
+        pickler_type, compression, frame_num = self.__unpack_header(view)
+        offset = len(self.__magic) + self.__header.size
+        lengths = []
+        for _ in range(frame_num):
+            lengths.append(self.__length.unpack_from(view, offset)[0])
+            offset += self.__length.size
+        return pickler_type, compression, lengths, offset
+
+    @classmethod
+    def __load_frames(
+        cls,
+        pickler_type: int,
+        compression: int,
+        lengths: list[int],
+        frames: list,
+    ) -> object:
+        if compression != Compression.NoCompression:
+            decompress = _compressors[Compression(compression)][1]
+            frames = [
+                bytearray(decompress(frame))
+                if length & cls.__compressed_flag
+                else frame
+                for frame, length in zip(frames, lengths, strict=True)
+            ]
+        if pickler_type == _PicklerType.Dill:
+            return dill.loads(frames[0])
+        return pickle.loads(frames[0], buffers=frames[1:])
+
+
+__default_serializer = Serializer()
+
+
+def get_default_serializer() -> Serializer:
+    return __default_serializer
+
+
+def set_default_serializer(serializer: Serializer) -> None:
+    global __default_serializer  # noqa: PLW0603
+    __default_serializer = serializer
@@ -5,9 +5,21 @@ import time
 from collections.abc import Callable
 from enum import IntEnum, auto
 from pathlib import Path
+from typing import BinaryIO
 
 import dill
 
+from .serializer import Serializer, get_default_serializer
+
+
+def _load(f: BinaryIO, serializer: Serializer | None = None) -> object:
+    # Files written before Serializer are plain dill pickles
+    if not Serializer.is_serialized(f.read(4)):
+        f.seek(0)
+        return dill.load(f)
+    f.seek(0)
+    return (serializer or get_default_serializer()).load(f)
+
 
 class DataLocation(IntEnum):
     NoData = auto()
@@ -19,7 +31,10 @@ class SyncedDataStorage:
     """封装数据存储操作"""
 
     def __init__(
-        self, data: object = None, data_path: str | Path | None = None
+        self,
+        data: object = None,
+        data_path: str | Path | None = None,
+        serializer: Serializer | None = None,
     ) -> None:
         self.__data: object = data
         self.__data_path: Path | None = (
@@ -33,6 +48,12 @@ class SyncedDataStorage:
             self.__data_location = DataLocation.Disk
         self.__fd: int | None = None
         self.__use_tmp_file: bool = False
+        # Use the default serializer if not set
+        self.__serializer: Serializer | None = serializer
+
+    @property
+    def serializer(self) -> Serializer:
+        return self.__serializer or get_default_serializer()
 
     def has_data(self) -> bool:
         return self.__data_location != DataLocation.NoData
@@ -66,7 +87,7 @@ class SyncedDataStorage:
     def __load_data(self) -> object:
         assert self.__data_path is not None
         with self.__data_path.open("rb") as f:
-            return dill.load(f)
+            return _load(f, self.serializer)
 
     def __close_data_file(self) -> None:
         if self.__data_path is not None:
@@ -98,7 +119,8 @@ class SyncedDataStorage:
         if self.__data_hash is not None:
             return self.__data_hash
         hash_sha256 = hashlib.sha256()
-        hash_sha256.update(dill.dumps(self.data))
+        for frame in self.serializer.dumps_frames(self.data):
+            hash_sha256.update(frame)
         self.__data_hash = hash_sha256.hexdigest()
         return self.__data_hash
 
@@ -123,7 +145,7 @@ class SyncedDataStorage:
                     parent.mkdir(parents=True, exist_ok=True)
             assert self.__data_path is not None
             with self.__data_path.open("wb") as f:
-                dill.dump(self.__data, f)
+                self.serializer.dump(self.__data, f)
                 self.__data = None
                 self.__data_location = DataLocation.Disk
 
@@ -138,7 +160,7 @@ def persistent_cache(
             return None
         fd = os.open(p, flags=os.O_RDONLY)
         with os.fdopen(fd, "rb") as f:
-            res = dill.load(f)
+            res = _load(f)
         return res
 
     def write_data(data: object, p: Path) -> None:
@@ -146,7 +168,7 @@ def persistent_cache(
             p.unlink()
         fd = os.open(p, flags=os.O_CREAT | os.O_EXCL | os.O_WRONLY)
         with os.fdopen(fd, "wb") as f:
-            dill.dump(data, f)
+            get_default_serializer().dump(data, f)
 
     def wrap(fun: Callable) -> Callable:
         def wrap2(*args: object, **kwargs: object) -> object:
@@ -3,6 +3,7 @@ from __future__ import annotations
 import multiprocessing
 
 from ..concurrency import ProcessContext
+from ..storage.serializer import Serializer
 from .topology import Topology
 
 
@@ -37,23 +38,40 @@ class CentralTopology(Topology):
 
 class ProcessPipeCentralTopology(CentralTopology):
     def __init__(
-        self, *args: int, mp_context: ProcessContext | None = None, **kwargs: int
+        self,
+        *args: int,
+        mp_context: ProcessContext | None = None,
+        serializer: Serializer | None = None,
+        **kwargs: int,
     ) -> None:
         super().__init__(*args, **kwargs)
         self.__pipes: dict = {}
         if mp_context is None:
             mp_context = ProcessContext()
         self.__context = mp_context
+        # Send the bytes of serializer instead of pickled objects
+        self.__serializer: Serializer | None = serializer
         for worker_id in range(self.worker_num):
             # 0 => server 1=> worker
             self.__pipes[worker_id] = self.__context.create_pipe()
 
+    def __send(self, connection: object, data: object) -> None:
+        if self.__serializer is None:
+            connection.send(data)  # type: ignore[attr-defined]
+            return
+        connection.send_bytes(self.__serializer.dumps(data))  # type: ignore[attr-defined]
+
+    def __recv(self, connection: object) -> object:
+        if self.__serializer is None:
+            return connection.recv()  # type: ignore[attr-defined]
+        return self.__serializer.loads(connection.recv_bytes())  # type: ignore[attr-defined]
+
     def get_from_worker(self, worker_id: int) -> object:
         assert 0 <= worker_id < self.worker_num
-        return self.__pipes[worker_id][0].recv()
+        return self.__recv(self.__pipes[worker_id][0])
 
     def send_to_worker(self, worker_id: int, data: object) -> None:
-        self.__pipes[worker_id][0].send(data)
+        self.__send(self.__pipes[worker_id][0], data)
 
     def has_data_from_worker(self, worker_id: int) -> bool:
         assert 0 <= worker_id < self.worker_num
@@ -61,7 +79,7 @@ class ProcessPipeCentralTopology(CentralTopology):
 
     def get_from_server(self, worker_id: int) -> object:
         assert 0 <= worker_id < self.worker_num
-        return self.__pipes[worker_id][1].recv()
+        return self.__recv(self.__pipes[worker_id][1])
 
     def has_data_from_server(self, worker_id: int) -> bool:
         assert 0 <= worker_id < self.worker_num
@@ -69,7 +87,7 @@ class ProcessPipeCentralTopology(CentralTopology):
 
     def send_to_server(self, worker_id: int, data: object) -> None:
         assert 0 <= worker_id < self.worker_num
-        return self.__pipes[worker_id][1].send(data)
+        self.__send(self.__pipes[worker_id][1], data)
 
     def close_server_channel(self) -> None:
         for p in self.__pipes.values():
@@ -81,9 +99,15 @@ class ProcessPipeCentralTopology(CentralTopology):
 
 class ProcessQueueCentralTopology(CentralTopology):
     def __init__(
-        self, *args: int, mp_context: ProcessContext | None = None, **kwargs: int
+        self,
+        *args: int,
+        mp_context: ProcessContext | None = None,
+        serializer: Serializer | None = None,
+        **kwargs: int,
     ) -> None:
         super().__init__(*args, **kwargs)
+        # Put the bytes of serializer instead of objects pickled by the queues
+        self.__serializer: Serializer | None = serializer
         self.__queues: dict[
             int, tuple[multiprocessing.Queue, multiprocessing.Queue]
         ] = {}
@@ -98,18 +122,18 @@ class ProcessQueueCentralTopology(CentralTopology):
 
     def get_from_worker(self, worker_id: int) -> object:
         assert 0 <= worker_id < self.worker_num
-        return self.__queues[worker_id][1].get()
+        return self.__decode(self.__queues[worker_id][1].get())
 
     def has_data_from_worker(self, worker_id: int) -> bool:
         assert 0 <= worker_id < self.worker_num
         return not self.__queues[worker_id][1].empty()
 
     def send_to_worker(self, worker_id: int, data: object) -> None:
-        self.__queues[worker_id][0].put(data)
+        self.__queues[worker_id][0].put(self.__encode(data))
 
     def get_from_server(self, worker_id: int) -> object:
         assert 0 <= worker_id < self.worker_num
-        return self.__queues[worker_id][0].get()
+        return self.__decode(self.__queues[worker_id][0].get())
 
     def has_data_from_server(self, worker_id: int) -> bool:
         assert 0 <= worker_id < self.worker_num
@@ -117,7 +141,18 @@ class ProcessQueueCentralTopology(CentralTopology):
 
     def send_to_server(self, worker_id: int, data: object) -> None:
         assert 0 <= worker_id < self.worker_num
-        self.__queues[worker_id][1].put(data)
+        self.__queues[worker_id][1].put(self.__encode(data))
+
+    def __encode(self, data: object) -> object:
+        if self.__serializer is None:
+            return data
+        return self.__serializer.dumps(data)
+
+    def __decode(self, data: object) -> object:
+        if self.__serializer is None:
+            return data
+        assert isinstance(data, bytearray)
+        return self.__serializer.loads(data)
 
     def close_server_channel(self) -> None:
         pass
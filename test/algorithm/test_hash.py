@@ -0,0 +1,28 @@
+from cyy_naive_lib.algorithm.hash import (
+    fingerprint,
+    jump_consistent_hash,
+    stable_hash,
+)
+
+
+def test_stable_hash() -> None:
+    assert stable_hash("abc") == stable_hash("abc")
+    assert stable_hash(("a", 1)) == stable_hash(("a", 1))
+    assert stable_hash(1) == 1
+
+
+def test_fingerprint() -> None:
+    assert fingerprint(("a", 1)) == fingerprint(("a", 1))
+    assert fingerprint(("a", 1)) != fingerprint(("a", 2))
+    assert fingerprint(lambda: None) is None
+
+
+def test_jump_consistent_hash() -> None:
+    keys = [f"key{i}" for i in range(1000)]
+    buckets = [jump_consistent_hash(key, 4) for key in keys]
+    assert set(buckets) == {0, 1, 2, 3}
+    moved = sum(
+        jump_consistent_hash(key, 5) != bucket
+        for key, bucket in zip(keys, buckets, strict=True)
+    )
+    assert moved < 300
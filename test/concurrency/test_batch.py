@@ -16,5 +16,7 @@ def test_batch_process() -> None:
         queue.start(worker_fun=worker)
         tasks = list(range(5))
         res = batch_process(queue, tasks)
+        assert res == dict(zip(tasks, tasks, strict=False))
+        res = batch_process(queue, tasks, chunk_size=2)
         queue.stop()
         assert res == dict(zip(tasks, tasks, strict=False))
@@ -1,8 +1,10 @@
 import multiprocessing
+import os
 import threading
+import time
 
 import pytest
-from cyy_naive_lib.concurrency import ProcessPool, ThreadPool
+from cyy_naive_lib.concurrency import ProcessPool, ThreadPool, WorkerRecyclingPolicy
 
 try:
     from cyy_naive_lib.concurrency import ProcessPoolWithCoroutine
@@ -25,12 +27,44 @@ def test_thread_pool() -> None:
     pool.shutdown()
 
 
+def test_thread_pool_deduplication() -> None:
+    pool = ThreadPool(deduplicate_tasks=True)
+    future = pool.submit(time.sleep, 0.1)
+    assert pool.submit(time.sleep, 0.1) is future
+    assert pool.submit(time.sleep, 0.2) is not future
+    future.result()
+    assert pool.submit(time.sleep, 0.1) is not future
+    pool.shutdown()
+
+
 def test_process_pool() -> None:
     pool: ProcessPool = ProcessPool()
     pool.submit(process_fun)
     pool.shutdown()
 
 
+def test_process_pool_recycling() -> None:
+    pool = ProcessPool(
+        max_workers=1, recycling_policy=WorkerRecyclingPolicy(max_tasks=2)
+    )
+    pids = [pool.submit(os.getpid).result() for _ in range(4)]
+    assert pids[0] == pids[1] != pids[2] == pids[3]
+    pool.shutdown()
+
+    pool = ProcessPool(max_workers=1, recycling_policy=WorkerRecyclingPolicy(max_rss=1))
+    pids = [pool.submit(os.getpid).result() for _ in range(2)]
+    assert pids[0] != pids[1]
+    pool.shutdown()
+
+    pool = ProcessPool(
+        max_workers=1, recycling_policy=WorkerRecyclingPolicy(max_idle_seconds=0.1)
+    )
+    pid = pool.submit(os.getpid).result()
+    time.sleep(1)
+    assert pool.submit(os.getpid).result() != pid
+    pool.shutdown()
+
+
 @pytest.mark.skipif(ProcessPoolWithCoroutine is None, reason="gevent not installed")
 def test_process_with_coroutine() -> None:
     pool = ProcessPoolWithCoroutine()
@@ -0,0 +1,50 @@
+from typing import Any
+
+import pytest
+from cyy_naive_lib.concurrency import (
+    Pipeline,
+    RetryableBatchPolicy,
+    SchedulingMode,
+    TaskQueueOptions,
+)
+
+
+def double(task: Any, **kwargs: Any) -> Any:
+    return task * 2
+
+
+def batch_increase(tasks: Any, **kwargs: Any) -> Any:
+    return [task + 1 for task in tasks]
+
+
+def test_pipeline() -> None:
+    pipeline = Pipeline()
+    pipeline.add_stage(double, worker_num=2)
+    pipeline.add_stage(
+        batch_increase,
+        use_thread=True,
+        batch_policy_type=RetryableBatchPolicy,
+        options=TaskQueueOptions(task_queue_maxsize=2),
+    )
+    pipeline.start()
+    pipeline.add_tasks(range(10))
+    for task in range(10, 20):
+        pipeline.add_task(task)
+    results: list = []
+    while len(results) < 20:
+        results += pipeline.get_many(max_items=20 - len(results), timeout=60)
+    assert sorted(results) == [task * 2 + 1 for task in range(20)]
+    pipeline.stop()
+
+
+def test_work_stealing_stage() -> None:
+    pipeline = Pipeline()
+    pipeline.add_stage(
+        double, options=TaskQueueOptions(scheduling_mode=SchedulingMode.WorkStealing)
+    )
+    # A later stage can't steal tasks.
+    with pytest.raises(ValueError):
+        pipeline.add_stage(
+            double,
+            options=TaskQueueOptions(scheduling_mode=SchedulingMode.WorkStealing),
+        )
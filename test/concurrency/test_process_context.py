@@ -1,4 +1,11 @@
-from cyy_naive_lib.concurrency import ProcessContext
+import multiprocessing
+from typing import Any
+
+from cyy_naive_lib.concurrency import ProcessContext, ProcessTaskQueue
+
+
+def double(task: Any, **kwargs: Any) -> Any:
+    return task * 2
 
 
 def test_pipe() -> None:
@@ -6,3 +13,17 @@ def test_pipe() -> None:
     p, q = ctx.create_pipe()
     p.send(1)
     assert q.recv() == 1
+
+
+def test_start_method() -> None:
+    assert ProcessContext().get_start_method() == "spawn"
+    ctx = ProcessContext(multiprocessing.get_context("fork"))
+    assert ctx.get_start_method() == "fork"
+    ctx = ProcessContext(start_method="forkserver", preload_modules=["cyy_naive_lib"])
+    assert ctx.get_start_method() == "forkserver"
+    for start_method in ("fork", "forkserver"):
+        queue = ProcessTaskQueue(mp_ctx=ProcessContext(start_method=start_method))
+        queue.start(worker_fun=double)
+        queue.add_task(1)
+        assert queue.get_data().value() == 2
+        queue.stop()
@@ -4,6 +4,8 @@ from typing import Any
 from cyy_naive_lib.concurrency import (
     ManageredProcessContext,
     ProcessTaskQueue,
+    QueueType,
+    TaskQueueOptions,
     ThreadTaskQueue,
 )
 from cyy_naive_lib.log import log_info
@@ -42,3 +44,16 @@ def test_process_task_queue() -> None:
         data = queue.get_data()
         assert data.is_ok() and data.value() == "abc"
         queue.stop()
+
+
+def test_shared_memory_task_queue() -> None:
+    queue = ProcessTaskQueue(
+        worker_num=2, options=TaskQueueOptions(queue_type=QueueType.SharedMemory)
+    )
+    queue.start(worker_fun=hello)
+    for _ in range(10):
+        queue.add_task(())
+    for _ in range(10):
+        data = queue.get_data()
+        assert data.is_ok() and data.value() == "abc"
+    queue.stop()
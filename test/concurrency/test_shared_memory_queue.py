@@ -0,0 +1,51 @@
+import pickle
+import queue
+
+import pytest
+from cyy_naive_lib.concurrency import ProcessContext, SharedMemoryQueue
+from cyy_naive_lib.storage import Serializer
+
+
+def test_shared_memory_queue() -> None:
+    q = ProcessContext().create_shared_memory_queue()
+    assert isinstance(q, SharedMemoryQueue)
+    assert q.empty()
+    q.put(1)
+    q.put({"a": [1, 2, 3]})
+    assert q.qsize() == 2
+    assert q.get() == 1
+    assert q.get() == {"a": [1, 2, 3]}
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+    q.close()
+
+
+def test_shared_memory_queue_wrap_around() -> None:
+    ctx = ProcessContext().get_ctx()
+    q = SharedMemoryQueue(condition=ctx.Condition(), capacity=256)
+    for i in range(100):
+        q.put("x" * (i % 50))
+        assert q.get() == "x" * (i % 50)
+    with pytest.raises(ValueError):
+        q.put("x" * 1024)
+    q.put("x" * 150)
+    with pytest.raises(queue.Full):
+        q.put("x" * 150, timeout=0.01)
+    q.close()
+
+
+def test_shared_memory_queue_serializer() -> None:
+    ctx = ProcessContext().get_ctx()
+    q = SharedMemoryQueue(
+        condition=ctx.Condition(), capacity=4096, serializer=Serializer()
+    )
+    for i in range(1, 20):
+        data = {
+            "buffer": pickle.PickleBuffer(bytearray(b"x" * (i * 100))),
+            "fun": lambda i=i: i,
+        }
+        q.put(data)
+        res = q.get()
+        assert bytes(res["buffer"]) == b"x" * (i * 100)
+        assert res["fun"]() == i
+    q.close()
@@ -1,12 +1,34 @@
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+from pathlib import Path
+from queue import Full
+from types import SimpleNamespace
 from typing import Any
 
+import psutil
+import pytest
 from cyy_naive_lib.concurrency import (
+    BatchPolicy,
+    ExpiredTask,
+    MemoryAwareBatchPolicy,
     ProcessTaskQueue,
+    QueueType,
     RetryableBatchPolicy,
+    SchedulingMode,
+    TaskOptions,
+    TaskPriority,
     TaskQueue,
+    TaskQueueOptions,
     ThreadTaskQueue,
+    WorkerScalingPolicy,
+    is_out_of_memory_error,
 )
+from cyy_naive_lib.concurrency.task_queue import RepeatedResult
 from cyy_naive_lib.log import log_warning
+from cyy_naive_lib.storage import Compression, Serializer, load_json
 
 
 def worker(task: Any, **kwargs: Any) -> Any:
@@ -47,3 +69,694 @@ def test_batch_task_queue() -> None:
             data = queue.get_data()
             assert data.is_ok() and data.value() == "abc"
         queue.stop()
+
+
+def batch_size_worker(tasks: Any, **kwargs: Any) -> Any:
+    return [len(tasks)] * len(tasks)
+
+
+def test_batch_latency() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            batch_policy_type=BatchPolicy,
+            options=TaskQueueOptions(max_batch_latency=0.5),
+        )
+        queue.start(worker_fun=batch_size_worker)
+        queue.add_task(0)
+        # The first batch waits for the target size of one only.
+        assert queue.get_data(timeout=5).value() == 1
+        for task in range(100):
+            queue.add_task(task)
+        batch_sizes = queue.get_many(max_items=100)
+        while len(batch_sizes) < 100:
+            batch_sizes += queue.get_many(max_items=100 - len(batch_sizes))
+        assert max(batch_sizes) > 1
+        queue.stop()
+
+
+def test_bulk_data() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=2, batch_policy_type=RetryableBatchPolicy)
+        queue.start(worker_fun=batch_worker)
+        queue.put_many(list(range(10)), queue_name="__task")
+        results: list = []
+        while len(results) < 10:
+            results += queue.get_many(max_items=10)
+        assert results == ["abc"] * 10
+        queue.stop()
+
+
+def rendezvous_worker(task: Any, worker_id: int, **kwargs: Any) -> Any:
+    # Wait for the other workers to take a task too, so no worker takes two.
+    marker_dir = Path(task)
+    (marker_dir / str(worker_id)).touch()
+    deadline = time.monotonic() + 10
+    while len(list(marker_dir.iterdir())) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return worker_id
+
+
+def test_bulk_tasks_spread_over_workers(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        marker_dir = tmp_path / queue_type.__name__
+        marker_dir.mkdir()
+        queue = queue_type(worker_num=2)
+        queue.start(worker_fun=rendezvous_worker)
+        queue.put_many([str(marker_dir)] * 2, queue_name="__task")
+        assert {queue.get_data().value() for _ in range(2)} == {0, 1}
+        queue.stop()
+        for scheduling_mode in SchedulingMode:
+            marker_dir = tmp_path / f"{queue_type.__name__}_{scheduling_mode}"
+            marker_dir.mkdir()
+            queue = queue_type(
+                worker_num=2,
+                options=TaskQueueOptions(scheduling_mode=scheduling_mode),
+            )
+            queue.start(worker_fun=rendezvous_worker)
+            queue.add_tasks([str(marker_dir)] * 2)
+            assert {queue.get_data().value() for _ in range(2)} == {0, 1}
+            queue.stop()
+
+
+def repeated_worker(task: Any, **kwargs: Any) -> Any:
+    return RepeatedResult(data=[task], num=3, copy_data=task == "copy")
+
+
+def test_repeated_result() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1)
+        queue.start(worker_fun=repeated_worker)
+        for task in ("copy", "share"):
+            queue.add_task(task)
+            results = queue.get_many(max_items=3)
+            while len(results) < 3:
+                results += queue.get_many(max_items=3 - len(results))
+            assert results == [[task]] * 3
+            assert (results[0] is results[1]) == (task == "share")
+            assert not queue.has_data()
+        queue.stop()
+
+
+def test_work_stealing() -> None:
+    for queue_type in get_queue_types():
+        for batch_policy_type in (None, RetryableBatchPolicy):
+            queue = queue_type(
+                worker_num=3,
+                batch_policy_type=batch_policy_type,
+                options=TaskQueueOptions(scheduling_mode=SchedulingMode.WorkStealing),
+            )
+            queue.start(
+                worker_fun=worker if batch_policy_type is None else batch_worker
+            )
+            for _ in range(10):
+                queue.add_task(())
+            queue.add_tasks([()] * 10)
+            for _ in range(20):
+                data = queue.get_data()
+                assert data.is_ok() and data.value() == "abc"
+            queue.stop()
+
+
+def worker_id_worker(task: Any, worker_id: int, **kwargs: Any) -> Any:
+    return worker_id
+
+
+def test_key_affinity() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=4, options=TaskQueueOptions(use_task_keys=True))
+        queue.start(worker_fun=worker_id_worker)
+        for key in ("a", "b"):
+            for _ in range(5):
+                queue.add_task((), options=TaskOptions(key=key))
+            worker_ids = {queue.get_data().value() for _ in range(5)}
+            assert len(worker_ids) == 1
+        queue.add_task(())
+        assert queue.get_data().is_ok()
+        queue.stop()
+
+
+def test_task_options_need_queues() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1)
+        queue.start(worker_fun=worker)
+        with pytest.raises(ValueError):
+            queue.add_task((), options=TaskOptions(key="a"))
+        with pytest.raises(ValueError):
+            queue.add_task((), options=TaskOptions(priority=TaskPriority.High))
+        with pytest.raises(ValueError):
+            queue.submit(())
+        queue.add_task((), options=TaskOptions())
+        assert queue.get_data().value() == "abc"
+        queue.stop()
+
+
+def sleep_worker(task: Any, **kwargs: Any) -> Any:
+    time.sleep(0.01)
+    return task
+
+
+def test_worker_scaling() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            options=TaskQueueOptions(
+                worker_scaling_policy=WorkerScalingPolicy(
+                    min_worker_num=1,
+                    max_worker_num=3,
+                    interval=0.05,
+                    backlog_per_worker=1,
+                    idle_seconds=0.1,
+                    max_cpu_percent=100,
+                    min_available_memory_percent=0,
+                ),
+            ),
+        )
+        queue.start(worker_fun=sleep_worker)
+        for i in range(200):
+            queue.add_task(i, options=TaskOptions(key=i))
+        results = [queue.get_data().value() for _ in range(200)]
+        assert sorted(results) == list(range(200))
+        assert queue.worker_num > 1
+        time.sleep(2)
+        assert queue.worker_num == 1
+        queue.stop()
+
+
+def failing_worker(task: Any, **kwargs: Any) -> Any:
+    if task < 0:
+        raise ValueError(task)
+    return task
+
+
+def failing_batch_worker(tasks: Any, **kwargs: Any) -> Any:
+    if any(task < 0 for task in tasks):
+        raise ValueError(tasks)
+    return tasks
+
+
+def test_submit() -> None:
+    for queue_type in get_queue_types():
+        for batch_policy_type in (None, RetryableBatchPolicy):
+            queue = queue_type(
+                worker_num=2,
+                batch_policy_type=batch_policy_type,
+                options=TaskQueueOptions(use_futures=True),
+            )
+            queue.start(
+                worker_fun=failing_worker
+                if batch_policy_type is None
+                else failing_batch_worker
+            )
+            future = queue.submit(1)
+            assert future.result() == 1
+            future = queue.submit(-1)
+            assert isinstance(future.exception(), ValueError)
+            assert list(queue.imap(range(20), max_in_flight=3)) == list(range(20))
+            assert sorted(queue.imap(range(20), ordered=False)) == list(range(20))
+            assert not queue.has_data()
+            # The result of a cancelled task is dropped
+            queue.submit(3).cancel()
+            assert queue.submit(4).result() == 4
+            future = queue.submit(2)
+            queue.stop()
+            assert future.done()
+            assert isinstance(future, concurrent.futures.Future)
+
+
+def test_bounded_task_queue() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1, options=TaskQueueOptions(task_queue_maxsize=1))
+        queue.start(worker_fun=sleep_worker)
+        with pytest.raises(Full):
+            for _ in range(10):
+                queue.add_task(0.1, block=False)
+        queue.add_task(0.1, timeout=10)
+        queue.force_stop()
+        # The bound counts tasks, not add_tasks calls.
+        queue = queue_type(worker_num=1, options=TaskQueueOptions(task_queue_maxsize=2))
+        queue.start(worker_fun=slow_worker)
+        queue.add_task(0)
+        while queue.task_backlog:
+            time.sleep(0.01)
+        with pytest.raises(Full):
+            queue.add_tasks(range(100), block=False)
+        assert queue.task_backlog == 2
+        queue.force_stop()
+
+
+def test_batch_size_exploration() -> None:
+    policy = BatchPolicy()
+    batch_size = 1
+    explored_batch_sizes = set()
+    for _ in range(30):
+        explored_batch_sizes.add(batch_size)
+        # The time per task is minimal at a batch size of 100.
+        policy._add_sample(batch_size, 100 / batch_size + batch_size / 100)
+        batch_size = policy.explore_batch_size(batch_size)
+    assert 64 <= batch_size <= 160
+    assert len(explored_batch_sizes) < 20
+
+
+def test_batch_policy_state(tmp_path: Path) -> None:
+    state_file = str(tmp_path / "state.json")
+    policy = RetryableBatchPolicy()
+    policy.set_state_file(state_file)
+    policy._add_sample(8, 1)
+    run_failed_batch(policy, 64, MemoryError())
+    policy.sync_state(force=True)
+    other_policy = RetryableBatchPolicy()
+    other_policy.set_state_file(state_file)
+    other_policy.sync_state(force=True)
+    assert other_policy.explore_batch_size(1) == 16
+    assert not other_policy.is_batch_size_allowed(64)
+
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=2,
+            batch_policy_type=RetryableBatchPolicy,
+            options=TaskQueueOptions(batch_policy_state_dir=str(tmp_path)),
+        )
+        queue.start(worker_fun=batch_worker)
+        for task in range(10):
+            queue.add_task(task)
+        for _ in range(10):
+            assert queue.get_data().value() == "abc"
+        queue.stop()
+    state_files = list(tmp_path.glob("*batch_worker.json"))
+    assert len(state_files) == 1
+    assert load_json(state_files[0])["processing_times"]
+
+
+def run_failed_batch(
+    policy: RetryableBatchPolicy, batch_size: int, exception: BaseException
+) -> None:
+    policy.set_current_batch_size(batch_size)
+    try:
+        with policy:
+            raise exception
+    except type(exception):
+        pass
+
+
+def test_batch_size_cool_down() -> None:
+    policy = RetryableBatchPolicy(cool_down=0.1, is_retryable=is_out_of_memory_error)
+    run_failed_batch(policy, 8, ValueError())
+    assert policy.is_batch_size_allowed(8)
+    run_failed_batch(policy, 8, RuntimeError("CUDA out of memory"))
+    assert not policy.is_batch_size_allowed(16)
+    time.sleep(0.1)
+    assert policy.is_batch_size_allowed(16)
+    run_failed_batch(policy, 8, MemoryError())
+    time.sleep(0.1)
+    # The second failure doubles the cool down.
+    assert not policy.is_batch_size_allowed(8)
+    time.sleep(0.1)
+    policy.set_current_batch_size(8)
+    with policy:
+        pass
+    assert policy.is_batch_size_allowed(policy.max_batch_size)
+    assert not any(policy._failure_numbers.values())
+
+
+def test_batch_size_cool_down_state(tmp_path: Path) -> None:
+    state_file = str(tmp_path / "state.json")
+    policy = RetryableBatchPolicy(cool_down=0.1)
+    policy.set_state_file(state_file)
+    run_failed_batch(policy, 8, MemoryError())
+    time.sleep(0.1)
+    run_failed_batch(policy, 8, MemoryError())
+    time.sleep(0.2)
+    policy.set_current_batch_size(8)
+    with policy:
+        pass
+    policy.sync_state(force=True)
+    # The success has reset the failures, the cool down isn't doubled again.
+    run_failed_batch(policy, 8, MemoryError())
+    time.sleep(0.1)
+    assert policy.is_batch_size_allowed(8)
+    other_policy = RetryableBatchPolicy(cool_down=0.1)
+    other_policy.set_state_file(state_file)
+    other_policy.sync_state(force=True)
+    assert other_policy._failure_numbers[8] == 1
+
+
+def test_memory_aware_batch_policy() -> None:
+    policy = MemoryAwareBatchPolicy(min_available_memory_percent=100)
+    policy.set_current_batch_size(8)
+    with policy:
+        pass
+    assert policy.explore_batch_size(8) == 1
+    assert not policy.is_batch_size_allowed(2)
+
+    # Memory freed before the end of the batch still counts
+    policy = MemoryAwareBatchPolicy(min_available_memory_percent=0)
+    policy.set_current_batch_size(1)
+    with policy:
+        data = b"a" * 128 * 1024 * 1024
+        del data
+    assert not policy.is_batch_size_allowed(policy.max_batch_size)
+
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1, batch_policy_type=MemoryAwareBatchPolicy)
+        queue.start(worker_fun=batch_worker)
+        for task in range(5):
+            queue.add_task(task)
+        for _ in range(5):
+            assert queue.get_data().value() == "abc"
+        queue.stop()
+
+
+def test_memory_aware_batch_policy_low_headroom(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Less headroom than a task takes still allows batches of one task
+    monkeypatch.setattr(
+        psutil,
+        "virtual_memory",
+        lambda: SimpleNamespace(total=1024**4, available=10 * 1024 * 1024),
+    )
+    policy = MemoryAwareBatchPolicy(min_available_memory_percent=0)
+    policy.set_current_batch_size(1)
+    with policy:
+        data = b"a" * 64 * 1024 * 1024
+    del data
+    assert policy.explore_batch_size(8) == 1
+    policy.set_current_batch_size(1)
+    with policy:
+        pass
+
+
+def test_wait_any() -> None:
+    for queue_type in get_queue_types():
+        # Pipes can't be task queues.
+        with pytest.raises(ValueError):
+            queue_type(
+                worker_num=1, options=TaskQueueOptions(queue_type=QueueType.Pipe)
+            )
+        for data_queue_type in QueueType:
+            # Only custom queues can be pipes.
+            queue = queue_type(
+                worker_num=1,
+                options=TaskQueueOptions(
+                    queue_type=QueueType.Queue
+                    if data_queue_type == QueueType.Pipe
+                    else data_queue_type
+                ),
+            )
+            queue.start(worker_fun=sleep_worker)
+            queue.add_queue("custom", queue_type=data_queue_type)
+            assert not queue.wait_any(["__result", "custom"], timeout=0.01)
+            queue.add_task(1)
+            assert queue.wait_any(["__result", "custom"]) == ["__result"]
+            queue.put_data(2, queue_name="custom")
+            assert queue.wait_any(["custom"], timeout=10) == ["custom"]
+            assert queue.get_data(queue_name="custom").value() == 2
+            queue.stop()
+
+
+def blocking_worker(task: Any, **kwargs: Any) -> Any:
+    if isinstance(task, Path):
+        task.touch()
+        time.sleep(0.5)
+        return "first"
+    return task
+
+
+def test_task_priority(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            options=TaskQueueOptions(
+                flag_expired_tasks=True, use_task_priorities=True, use_futures=True
+            ),
+        )
+        queue.start(worker_fun=blocking_worker)
+        marker = tmp_path / queue_type.__name__
+        queue.add_task(marker)
+        # Wait until the worker is busy with the first task
+        while not marker.exists():
+            time.sleep(0.01)
+        queue.add_task("low", options=TaskOptions(priority=TaskPriority.Low))
+        queue.add_task("normal")
+        queue.add_task("high", options=TaskOptions(priority=TaskPriority.High))
+        queue.add_task("expired", options=TaskOptions(deadline=time.time()))
+        results = [queue.get_data().value() for _ in range(5)]
+        expired_tasks = [
+            result for result in results if isinstance(result, ExpiredTask)
+        ]
+        assert len(expired_tasks) == 1
+        assert expired_tasks[0].task == "expired"
+        assert [result for result in results if isinstance(result, str)] == [
+            "first",
+            "high",
+            "normal",
+            "low",
+        ]
+        future = queue.submit("expired", options=TaskOptions(deadline=time.time() - 1))
+        assert isinstance(future.exception(timeout=10), TimeoutError)
+        queue.stop()
+
+
+def test_task_deduplication() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            options=TaskQueueOptions(
+                deduplicate_tasks=True, use_task_keys=True, use_task_priorities=True
+            ),
+        )
+        queue.start(worker_fun=blocking_worker)
+        future = queue.submit("slow")
+        assert queue.submit("slow") is future
+        assert queue.submit("slow", options=TaskOptions(key=1)) is not future
+        # A duplicate with another deadline or priority doesn't share its fate.
+        assert (
+            queue.submit("slow", options=TaskOptions(deadline=time.time() + 60))
+            is not future
+        )
+        assert (
+            queue.submit("slow", options=TaskOptions(priority=TaskPriority.Low))
+            is not future
+        )
+        assert future.result(timeout=10) == "slow"
+        assert queue.submit("slow") is not future
+        queue.stop()
+
+
+def test_delayed_task() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1)
+        queue.start(worker_fun=sleep_worker)
+        start_time = time.monotonic()
+        queue.add_task("delayed", delay=0.3)
+        cancelled_timer_id = queue.add_task("cancelled", delay=0.2)
+        assert cancelled_timer_id is not None
+        assert queue.cancel_timer(cancelled_timer_id)
+        timer_id = queue.add_periodic_task("periodic", interval=0.1)
+        assert queue.get_data().value() == "periodic"
+        assert queue.get_data().value() == "periodic"
+        assert queue.cancel_timer(timer_id)
+        # A periodic task may have been queued before the cancellation
+        result = queue.get_data().value()
+        while result == "periodic":
+            result = queue.get_data().value()
+        assert result == "delayed"
+        assert time.monotonic() - start_time >= 0.3
+        time.sleep(0.2)
+        while queue.has_data():
+            assert queue.get_data().value() == "periodic"
+        queue.stop()
+
+
+def slow_worker(task: Any, **kwargs: Any) -> Any:
+    time.sleep(2)
+    return task
+
+
+def test_stop_timeout() -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(worker_num=1)
+        queue.start(worker_fun=slow_worker)
+        queue.add_tasks([1, 2, 3])
+        start_time = time.monotonic()
+        queue.stop(timeout=0.5)
+        assert time.monotonic() - start_time < 1.5
+
+
+def large_result_worker(task: Any, **kwargs: Any) -> Any:
+    return task * 2
+
+
+def test_spill_large_data(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        for data_queue_type in (QueueType.Queue, QueueType.SharedMemory):
+            queue = queue_type(
+                worker_num=1,
+                options=TaskQueueOptions(
+                    queue_type=data_queue_type,
+                    spill_threshold=1024,
+                    spill_dir=str(tmp_path),
+                ),
+            )
+            queue.start(worker_fun=large_result_worker)
+            queue.add_task(b"a" * 1024 * 1024)
+            queue.add_task(b"b")
+            results = sorted(queue.get_data().value() for _ in range(2))
+            assert results == [b"a" * 2 * 1024 * 1024, b"bb"]
+            queue.stop()
+            assert not list(tmp_path.iterdir())
+            # Results never read are removed too
+            queue.start(worker_fun=large_result_worker)
+            queue.add_task(b"a" * 1024 * 1024)
+            queue.stop()
+            assert not list(tmp_path.iterdir())
+
+
+def test_shared_memory_capacity(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            options=TaskQueueOptions(
+                queue_type=QueueType.SharedMemory,
+                shared_memory_capacity=64 * 1024,
+                spill_dir=str(tmp_path),
+            ),
+        )
+        queue.start(worker_fun=large_result_worker)
+        # Data over the capacity is sent through a file instead of ending the
+        # worker.
+        queue.add_task(b"a" * 64 * 1024)
+        assert queue.get_data(timeout=60).value() == b"a" * 128 * 1024
+        queue.add_task(b"b")
+        assert queue.get_data(timeout=60).value() == b"bb"
+        queue.add_queue("large", QueueType.SharedMemory, capacity=1024 * 1024)
+        queue.put_data(b"a" * 128 * 1024, queue_name="large")
+        assert not list(tmp_path.iterdir())
+        assert queue.get_data(queue_name="large").value() == b"a" * 128 * 1024
+        # Results never read are removed too
+        queue.add_task(b"a" * 64 * 1024)
+        queue.stop()
+        assert not list(tmp_path.iterdir())
+
+
+def test_serializer(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        for data_queue_type in (QueueType.Queue, QueueType.SharedMemory):
+            queue = queue_type(
+                worker_num=1,
+                options=TaskQueueOptions(
+                    queue_type=data_queue_type,
+                    serializer=Serializer(compression=Compression.Zlib),
+                    spill_threshold=1024 * 1024,
+                    spill_dir=str(tmp_path),
+                ),
+            )
+            queue.start(worker_fun=large_result_worker)
+            queue.add_task(b"a" * 1024 * 1024)
+            queue.add_task(b"b")
+            results = sorted(queue.get_data().value() for _ in range(2))
+            assert results == [b"a" * 2 * 1024 * 1024, b"bb"]
+            queue.add_queue("pipe", QueueType.Pipe)
+            for queue_name in ("__result", "pipe"):
+                queue.put_data(memoryview(bytearray(b"abc")), queue_name=queue_name)
+                data = queue.get_data(queue_name=queue_name, timeout=60).value()
+                assert data.tobytes() == b"abc" and not data.readonly
+            queue.stop()
+
+
+def crashing_worker(task: Any, **kwargs: Any) -> Any:
+    # Crash on the first attempt only, the marker file survives the worker.
+    marker = Path(task)
+    if not marker.exists():
+        marker.touch()
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("worker crashed")
+        os._exit(1)
+    return marker.name
+
+
+def test_task_redelivery(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        queue = queue_type(
+            worker_num=1,
+            options=TaskQueueOptions(
+                task_retry_limit=1, heartbeat_interval=0.1, use_futures=True
+            ),
+        )
+        queue.start(worker_fun=crashing_worker)
+        task_dir = tmp_path / queue_type.__name__
+        task_dir.mkdir()
+        queue.add_task(str(task_dir / "a"))
+        assert queue.get_data(timeout=60).value() == "a"
+        future = queue.submit(str(task_dir / "b"))
+        if queue_type is ThreadTaskQueue:
+            # A future gets the exception instead of killing the worker.
+            assert isinstance(future.exception(timeout=60), RuntimeError)
+        else:
+            assert future.result(timeout=60) == "b"
+        assert queue.worker_num == 1
+        queue.stop()
+
+
+class TaskLosingQueue(ProcessTaskQueue):
+    lost_task_marker: Path | None = None
+
+    def get_tasks(
+        self, max_tasks: int, timeout: float | None, worker_id: int | None = None
+    ) -> list:
+        # The first worker dies after taking a task but before leasing it.
+        marker = self.lost_task_marker
+        if (
+            worker_id is not None
+            and marker is not None
+            and not marker.exists()
+            and self.get_many(max_items=1, timeout=timeout, queue_name="__task")
+        ):
+            marker.touch()
+            os._exit(1)
+        return super().get_tasks(
+            max_tasks=max_tasks, timeout=timeout, worker_id=worker_id
+        )
+
+
+def test_lost_task_redelivery(tmp_path: Path) -> None:
+    queue = TaskLosingQueue(
+        worker_num=1,
+        options=TaskQueueOptions(task_retry_limit=1, heartbeat_interval=0.1),
+    )
+    queue.lost_task_marker = tmp_path / "lost"
+    queue.start(worker_fun=worker)
+    queue.add_task(())
+    assert queue.get_data(timeout=60).value() == "abc"
+    assert queue.lost_task_marker.exists()
+    queue.stop()
+
+
+def init_worker(path: str, worker_id: int) -> dict:
+    return {"path": path, "worker_id": worker_id, "count": 0}
+
+
+def stateful_worker(task: Any, state: dict, **kwargs: Any) -> Any:
+    state["count"] += 1
+    return state["count"]
+
+
+def teardown_worker(state: dict) -> None:
+    Path(state["path"]).write_text(str(state["count"]), encoding="utf8")
+
+
+def test_worker_state(tmp_path: Path) -> None:
+    for queue_type in get_queue_types():
+        path = tmp_path / queue_type.__name__
+        queue = queue_type(worker_num=1)
+        queue.start(
+            worker_fun=stateful_worker,
+            worker_init=functools.partial(init_worker, str(path)),
+            worker_teardown=teardown_worker,
+        )
+        for task in range(3):
+            queue.add_task(task)
+        assert [queue.get_data().value() for _ in range(3)] == [1, 2, 3]
+        queue.stop()
+        assert path.read_text(encoding="utf8") == "3"
@@ -0,0 +1,49 @@
+import time
+
+from cyy_naive_lib.concurrency import TimerWheel
+
+
+def test_timer_wheel() -> None:
+    wheel = TimerWheel(tick=0.01, slot_num=4, level_num=2)
+    start_time = time.monotonic()
+    for delay in (0.5, 0, 0.05, 0.2):
+        wheel.add(delay=delay, item=delay)
+    cancelled_timer_id = wheel.add(delay=0.1, item="cancelled")
+    assert wheel.cancel(cancelled_timer_id)
+    periodic_timer_id = wheel.add(delay=0.1, item="periodic", interval=0.1)
+    items: list = []
+    while 0.5 not in items:
+        time.sleep(0.01)
+        items += wheel.advance()
+        # A timer never expires early
+        for delay in (0.05, 0.2, 0.5):
+            if delay in items:
+                assert time.monotonic() - start_time >= delay
+    assert [item for item in items if item != "periodic"] == [0, 0.05, 0.2, 0.5]
+    assert wheel.cancel(periodic_timer_id)
+    assert len(wheel) == 0
+    assert wheel.next_due_time() is None
+
+
+def test_next_due_time() -> None:
+    wheel = TimerWheel(tick=0.01, slot_num=4, level_num=3)
+    near_timer_id = wheel.add(delay=0.02, item="near")
+    next_due_time = wheel.next_due_time()
+    assert next_due_time is not None
+    assert next_due_time - time.monotonic() <= 0.03
+    assert wheel.cancel(near_timer_id)
+
+    # A timer 1000 ticks away is reached through the slots of the upper levels
+    # instead of once per tick.
+    start_time = time.monotonic()
+    wheel.add(delay=10, item="far")
+    wake_up_num = 0
+    items: list = []
+    while not items:
+        next_due_time = wheel.next_due_time()
+        assert next_due_time is not None
+        items = wheel.advance(now=next_due_time)
+        wake_up_num += 1
+    assert items == ["far"]
+    assert next_due_time - start_time >= 10
+    assert wake_up_num < 50
@@ -1,7 +1,18 @@
+import io
+import pickle
 import shutil
+from pathlib import Path
 
+import dill
 from cyy_naive_lib.fs.tempdir import TempDir
-from cyy_naive_lib.storage import DataStorage, load_json, persistent_cache, save_json
+from cyy_naive_lib.storage import (
+    Compression,
+    DataStorage,
+    Serializer,
+    load_json,
+    persistent_cache,
+    save_json,
+)
 
 
 def test_storage() -> None:
@@ -16,6 +27,26 @@ def test_storage() -> None:
     assert data["c"] == "d"
 
 
+def test_serializer() -> None:
+    data = {"buffer": pickle.PickleBuffer(bytearray(b"abc" * 2000)), "fun": lambda: 1}
+    for compression in Compression:
+        serializer = Serializer(compression=compression)
+        res = serializer.loads(serializer.dumps(data))
+        assert bytes(res["buffer"]) == b"abc" * 2000
+        assert res["fun"]() == 1
+        f = io.BytesIO()
+        serializer.dump(data, f)
+        f.seek(0)
+        assert bytes(serializer.load(f)["buffer"]) == b"abc" * 2000
+
+
+def test_storage_legacy_file() -> None:
+    with TempDir():
+        with Path("data.pk").open("wb") as f:
+            dill.dump({1: 2}, f)
+        assert DataStorage(data_path="data.pk").data == {1: 2}
+
+
 def test_json_io() -> None:
     data = {1: 2, "c": "d"}
     with TempDir():
@@ -1,4 +1,8 @@
-from cyy_naive_lib.topology.central_topology import ProcessPipeCentralTopology
+from cyy_naive_lib.storage import Serializer
+from cyy_naive_lib.topology.central_topology import (
+    ProcessPipeCentralTopology,
+    ProcessQueueCentralTopology,
+)
 
 
 def test_process_task_queue() -> None:
@@ -8,3 +12,12 @@ def test_process_task_queue() -> None:
     topology = ProcessPipeCentralTopology(worker_num=3)
     topology.send_to_worker(worker_id=1, data="abc")
     assert topology.get_from_server(worker_id=1) == "abc"
+
+
+def test_topology_serializer() -> None:
+    for topology_type in (ProcessPipeCentralTopology, ProcessQueueCentralTopology):
+        topology = topology_type(worker_num=2, serializer=Serializer())
+        topology.send_to_worker(worker_id=1, data={"a": b"abc"})
+        assert topology.get_from_server(worker_id=1) == {"a": b"abc"}
+        topology.send_to_server(worker_id=0, data="def")
+        assert topology.get_from_worker(worker_id=0) == "def"